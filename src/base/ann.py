@@ -0,0 +1,178 @@
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate nearest neighbours by cosine similarity. Vectors are L2-normalized
+    and clustered with spherical k-means into n_lists lists around their centroids. A query is only compared
+    with the vectors of the n_probe lists whose centroids are the most similar to it: more probes give a
+    higher recall at a higher latency, and n_probe = n_lists is an exact search.
+
+    Vectors are stored sorted by list, so every list is a contiguous block. Saved indexes are memory-mapped
+    on load, and pickled as their absolute directory path alone: unpickled indexes only read their arrays
+    on first use.
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        list_starts: np.ndarray,
+        vectors: np.ndarray,
+        ids: np.ndarray,
+        n_probe: int = 8,
+        directory_path: str | None = None,
+    ):
+        self.centroids: np.ndarray = centroids
+        # List l holds vectors[list_starts[l]:list_starts[l + 1]], whose original rows are ids
+        self.list_starts: np.ndarray = list_starts
+        self.vectors: np.ndarray = vectors
+        self.ids: np.ndarray = ids
+        self.n_probe = n_probe
+        self.directory_path = directory_path
+
+    def __getstate__(self) -> dict:
+        if self.directory_path is None:
+            return self.__dict__.copy()
+        return {'directory_path': self.directory_path, 'n_probe': self.n_probe}
+
+    def __getattr__(self, name: str):
+        # Only reached for missing attributes: memory-map the arrays of a saved index on first use
+        directory_path = self.__dict__.get('directory_path')
+        arrays = ['centroids', 'list_starts', 'vectors', 'ids']
+        if directory_path is None or name not in arrays:
+            raise AttributeError(
+                f"'{type(self).__name__}' object has no attribute '{name}'"
+            )
+        index = IVFIndex.load(directory_path)
+        for array in arrays:
+            setattr(self, array, getattr(index, array))
+        return getattr(self, name)
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @staticmethod
+    def build(
+        vectors: np.ndarray,
+        n_lists: int | None = None,
+        n_probe: int = 8,
+        n_iterations: int = 20,
+        sample_size: int | None = None,
+        seed: int = 0,
+    ) -> 'IVFIndex':
+        """
+        Index of the rows of vectors. By default there are about sqrt(n_vectors) lists, and k-means is
+        trained on a sample of 256 vectors per list.
+        """
+        vectors = IVFIndex._normalize(np.asarray(vectors, dtype=np.float32))
+        n_vectors = len(vectors)
+        n_lists = min(n_lists or max(int(np.sqrt(n_vectors)), 1), n_vectors)
+        rng = np.random.default_rng(seed)
+        sample_size = min(sample_size or 256 * n_lists, n_vectors)
+        sample = vectors[rng.choice(n_vectors, sample_size, replace=False)]
+        centroids = IVFIndex._train_centroids(sample, n_lists, n_iterations, rng)
+        return IVFIndex._fill_lists(vectors, centroids, n_probe)
+
+    def reassign(self, vectors: np.ndarray) -> 'IVFIndex':
+        """
+        Index of new vectors (e.g. after more training) with the same centroids, without running k-means again.
+        Recall drops as the vectors drift away from the centroids: build the index again then.
+        """
+        vectors = IVFIndex._normalize(np.asarray(vectors, dtype=np.float32))
+        return IVFIndex._fill_lists(vectors, np.array(self.centroids), self.n_probe)
+
+    @staticmethod
+    def _fill_lists(
+        vectors: np.ndarray, centroids: np.ndarray, n_probe: int
+    ) -> 'IVFIndex':
+        lists = IVFIndex._assign(vectors, centroids)
+        ids = np.argsort(lists, kind='stable').astype(np.int32)
+        list_starts = np.searchsorted(lists[ids], np.arange(len(centroids) + 1))
+        return IVFIndex(centroids, list_starts, vectors[ids], ids, n_probe)
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    @staticmethod
+    def _assign(
+        vectors: np.ndarray, centroids: np.ndarray, block_size: int = 65_536
+    ) -> np.ndarray:
+        # Most similar centroid of every vector, over blocks of vectors to bound memory
+        return np.concatenate(
+            [
+                np.argmax(vectors[start : start + block_size] @ centroids.T, axis=1)
+                for start in range(0, len(vectors), block_size)
+            ]
+            or [np.empty(0, dtype=np.int64)]
+        )
+
+    @staticmethod
+    def _train_centroids(
+        sample: np.ndarray,
+        n_lists: int,
+        n_iterations: int,
+        rng: np.random.Generator,
+    ) -> np.ndarray:
+        # Spherical k-means: centroids are the normalized means of their vectors
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in tqdm(range(n_iterations)):
+            lists = IVFIndex._assign(sample, centroids)
+            order = np.argsort(lists, kind='stable')
+            list_sizes = np.bincount(lists, minlength=n_lists)
+            non_empty = np.flatnonzero(list_sizes)
+            sums = np.add.reduceat(
+                sample[order], np.cumsum(list_sizes)[non_empty] - list_sizes[non_empty]
+            )
+            centroids = centroids.copy()
+            centroids[non_empty] = IVFIndex._normalize(sums)
+            # Empty lists start again from random vectors
+            empty = np.flatnonzero(list_sizes == 0)
+            centroids[empty] = sample[rng.choice(len(sample), len(empty))]
+        return centroids
+
+    @staticmethod
+    def load(directory_path: str) -> 'IVFIndex':
+        directory_path = os.path.abspath(directory_path)
+        with open(os.path.join(directory_path, 'ivf.json')) as file:
+            metadata = json.load(file)
+        return IVFIndex(
+            *(
+                np.load(os.path.join(directory_path, f'{array}.npy'), mmap_mode='r')
+                for array in ['centroids', 'list_starts', 'vectors', 'ids']
+            ),
+            n_probe=metadata['n_probe'],
+            directory_path=directory_path,
+        )
+
+    def save(self, directory_path: str):
+        os.makedirs(directory_path, exist_ok=True)
+        for array in ['centroids', 'list_starts', 'vectors', 'ids']:
+            np.save(os.path.join(directory_path, f'{array}.npy'), getattr(self, array))
+        with open(os.path.join(directory_path, 'ivf.json'), 'w') as file:
+            json.dump({'n_probe': self.n_probe}, file, indent=2)
+        self.directory_path = os.path.abspath(directory_path)
+
+    def search(
+        self, query: np.ndarray, k: int, n_probe: int | None = None
+    ) -> (np.ndarray, np.ndarray):
+        """Original rows and cosine similarities of the (up to) k vectors most similar to query, best first"""
+        query = self._normalize(np.asarray(query, dtype=np.float32))
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        centroid_scores = self.centroids @ query
+        lists = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        candidates = np.concatenate(
+            [np.arange(self.list_starts[l], self.list_starts[l + 1]) for l in lists]
+        )
+        scores = self.vectors[candidates] @ query
+        if len(candidates) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return np.asarray(self.ids[candidates[order]]), scores[order]
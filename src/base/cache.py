@@ -0,0 +1,67 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class RecommendationCache:
+    """
+    Least recently used cache of recommendations, keyed by prompt (item and recommendation parameters).
+    Every entry remembers how many recommendations it holds, so a request for fewer of them is also a hit.
+    Entries older than ttl seconds, if given, count as misses and are dropped.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        # key -> (number of recommendations, value, insertion time), least recently used first
+        self._entries: OrderedDict[Hashable, tuple[int, Any, float]] = OrderedDict()
+
+    def __getstate__(self) -> dict:
+        # Insertion times are only meaningful within a process: pickled caches start empty
+        state = self.__dict__.copy()
+        state['_entries'] = OrderedDict()
+        return state
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, key: Hashable, n_recommendations: int) -> Any | None:
+        """Value cached for key with at least n_recommendations recommendations, or None"""
+        entry = self._entries.get(key)
+        if entry is not None and self._is_expired(entry):
+            del self._entries[key]
+            entry = None
+        if entry is None or entry[0] < n_recommendations:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, n_recommendations: int, value: Any):
+        entry = self._entries.get(key)
+        # A larger entry still answers this request too
+        if (
+            entry is not None
+            and entry[0] > n_recommendations
+            and not self._is_expired(entry)
+        ):
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = (n_recommendations, value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _is_expired(self, entry: tuple[int, Any, float]) -> bool:
+        return self.ttl is not None and time.monotonic() - entry[2] > self.ttl
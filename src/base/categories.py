@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+
+
+class CategoryTree:
+    """
+    Integer coded category hierarchy of a product catalogue.
+
+    Every prefix of a category code (electronics, electronics.audio, electronics.audio.headphone) is a node,
+    with a parent pointer and the range of products below it. Nodes are numbered in depth-first order, so the
+    subtree of a node is a contiguous range of node ids and its products a contiguous range of product_order.
+    Every product has one node per level (-1 past the end of its category), and every node a label code: nodes
+    of the same level with the same name share it, which is what per-level category comparisons need.
+    """
+
+    def __init__(self, category_codes: pd.Series):
+        codes, paths = pd.factorize(category_codes)
+        path_segments = [tuple(path.split('.')) for path in paths]
+        self.depth: int = max(map(len, path_segments), default=1)
+        nodes = sorted(
+            {
+                segments[:level]
+                for segments in path_segments
+                for level in range(1, len(segments) + 1)
+            }
+        )
+        node_ids = {node: node_id for node_id, node in enumerate(nodes)}
+        self.node_paths: np.ndarray = np.array(
+            ['.'.join(node) for node in nodes], dtype=object
+        )
+        self.node_levels: np.ndarray = np.array(
+            [len(node) - 1 for node in nodes], dtype=np.int8
+        )
+        self.node_parents: np.ndarray = np.array(
+            [node_ids.get(node[:-1], -1) for node in nodes], dtype=np.int32
+        )
+        self.level_labels: list[pd.Index] = [
+            pd.Index(sorted({node[-1] for node in nodes if len(node) == level + 1}))
+            for level in range(self.depth)
+        ]
+        self.node_labels: np.ndarray = np.array(
+            [self.level_labels[len(node) - 1].get_loc(node[-1]) for node in nodes],
+            dtype=np.int32,
+        )
+
+        # Nodes of every distinct category code, and a last row of -1 for products without category
+        path_nodes = np.full((len(paths) + 1, self.depth), -1, dtype=np.int32)
+        for path_index, segments in enumerate(path_segments):
+            for level in range(len(segments)):
+                path_nodes[path_index, level] = node_ids[segments[: level + 1]]
+        self.product_nodes: np.ndarray = path_nodes[codes]
+        # Label code of every product at every level, or -1 past the end of its category
+        self.product_labels: np.ndarray = np.where(
+            self.product_nodes >= 0,
+            self.node_labels[np.maximum(self.product_nodes, 0)],
+            -1,
+        ).astype(np.int32)
+
+        # Depth-first numbering: the subtree of a node ends at the next node that is not deeper
+        subtree_end = np.full(len(nodes), len(nodes), dtype=np.int32)
+        stack = []
+        for node_id, level in enumerate(self.node_levels):
+            while stack and self.node_levels[stack[-1]] >= level:
+                subtree_end[stack.pop()] = node_id
+            stack.append(node_id)
+        # Deepest node of every product, n_nodes for products without category
+        self.product_leaves: np.ndarray = np.where(
+            self.product_nodes[:, 0] >= 0,
+            self.product_nodes.max(axis=1),
+            len(nodes),
+        ).astype(np.int32)
+        self.product_order: np.ndarray = np.argsort(
+            self.product_leaves, kind='stable'
+        ).astype(np.int32)
+        sorted_leaves = self.product_leaves[self.product_order]
+        self.node_start: np.ndarray = np.searchsorted(
+            sorted_leaves, np.arange(len(nodes))
+        )
+        self.node_end: np.ndarray = np.searchsorted(sorted_leaves, subtree_end)
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.node_paths)
+
+    def get_level(self, level: int) -> pd.Categorical:
+        """Names of the products' categories at a level (0 based), as category_code_L{level + 1}"""
+        return pd.Categorical.from_codes(
+            self.product_labels[:, level], categories=self.level_labels[level]
+        )
+
+    def get_node(self, category_code: str) -> int:
+        """Node of a category code or prefix, or -1 if it is not in the tree"""
+        return int(pd.Index(self.node_paths).get_indexer([category_code])[0])
+
+    def get_products(self, node: int) -> np.ndarray:
+        """Product indices of the node and all its descendants"""
+        return self.product_order[self.node_start[node] : self.node_end[node]]
+
+    def get_prefix_products(self, category_prefix: str) -> np.ndarray:
+        """Product indices whose category code starts with the given levels (e.g. electronics.audio)"""
+        node = self.get_node(category_prefix)
+        if node < 0:
+            return np.empty(0, dtype=np.int32)
+        return self.get_products(node)
+
+    def get_level_matches(self, product_index: int) -> (np.ndarray, int):
+        """
+        Number of levels where every product has the same category name as the given one, and the number of
+        levels of the given product's category.
+        """
+        labels = self.product_labels
+        anchor = labels[product_index]
+        levels = anchor >= 0
+        matches = (labels[:, levels] == anchor[levels]).sum(axis=1)
+        return matches, int(levels.sum())
@@ -0,0 +1,238 @@
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from base.dataset import DataSet
+
+
+class CategoryIndex:
+    """
+    Products grouped into buckets of equal category (one per category code, plus one for products without
+    category), sorted by popularity (times sold, descending) and then price (ascending) within every bucket,
+    and again within every (bucket, brand) sub-bucket.
+
+    Every product of a bucket has the same category proximity to any anchor and, for a given anchor, the
+    same brand proximity within a sub-bucket, so the best candidates of a bucket are the first ones of the
+    anchor's brand sub-bucket and the first ones of other brands.
+    """
+
+    def __init__(self, dataset: DataSet):
+        category_tree = dataset.category_tree
+        products = dataset.products
+        self.buckets: np.ndarray = category_tree.product_leaves
+        n_buckets = category_tree.n_nodes + 1
+        # Category label codes of every bucket, from any of its products (-1 past the end of the category)
+        self.bucket_labels: np.ndarray = np.full(
+            (n_buckets, category_tree.depth), -1, dtype=np.int32
+        )
+        self.bucket_labels[self.buckets] = category_tree.product_labels
+        brands, _ = pd.factorize(products['brand'])
+        self.brands: np.ndarray = brands.astype(np.int32)
+        self.sales: np.ndarray = (
+            dataset.metrics['sales_count']
+            .reindex(products.index)
+            .fillna(0)
+            .to_numpy(dtype=np.float64)
+        )
+        self.prices: np.ndarray = products['price'].to_numpy(dtype=np.float64)
+        self.bucket_sales: np.ndarray = np.bincount(
+            self.buckets, weights=self.sales, minlength=n_buckets
+        )
+
+        self.bucket_order: np.ndarray = np.lexsort(
+            (self.prices, -self.sales, self.buckets)
+        ).astype(np.int32)
+        self.bucket_starts: np.ndarray = np.searchsorted(
+            self.buckets[self.bucket_order], np.arange(n_buckets + 1)
+        )
+        # Sub-buckets are keyed by bucket * n_brands + brand, for products with a brand
+        self.n_brands = int(self.brands.max(initial=-1)) + 1
+        branded = np.flatnonzero(self.brands >= 0)
+        brand_keys = self.buckets[branded].astype(np.int64) * self.n_brands + (
+            self.brands[branded]
+        )
+        order = np.lexsort((self.prices[branded], -self.sales[branded], brand_keys))
+        self.brand_order: np.ndarray = branded[order].astype(np.int32)
+        self.brand_keys, self.brand_starts = np.unique(
+            brand_keys[order], return_index=True
+        )
+        self.brand_ends: np.ndarray = np.append(
+            self.brand_starts[1:], len(self.brand_order)
+        )
+
+    def get_category_scores(self, item_index: int) -> np.ndarray:
+        """Category proximity of every bucket to a product: share of its category levels with the same name"""
+        anchor_labels = self.bucket_labels[self.buckets[item_index]]
+        levels = anchor_labels >= 0
+        matches = (self.bucket_labels[:, levels] == anchor_labels[levels]).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return matches / levels.sum()
+
+    def _get_brand_bucket(self, bucket: int, brand: int) -> np.ndarray:
+        key = bucket * self.n_brands + brand
+        position = np.searchsorted(self.brand_keys, key)
+        if position == len(self.brand_keys) or self.brand_keys[position] != key:
+            return self.brand_order[:0]
+        return self.brand_order[self.brand_starts[position] : self.brand_ends[position]]
+
+    def get_top_k(
+        self,
+        item_index: int,
+        k: int,
+        category_score_cutoff: float,
+        brand_score_weight: float,
+        popularity_score_weight: float,
+    ) -> dict[str, np.ndarray]:
+        """
+        Best k products for an anchor product, by score = category_score * (brand_score_weight * brand_score
+        + popularity_score_weight * popularity_score) and then by price. Only buckets with a category score of
+        at least category_score_cutoff are read, and at most 2k products of each of them.
+        """
+        category_scores = self.get_category_scores(item_index)
+        buckets = np.flatnonzero(category_scores >= category_score_cutoff)
+        # Popularity is the share of sales among all the products that pass the cutoff
+        total_sales = self.bucket_sales[buckets].sum()
+        brand = self.brands[item_index]
+        candidates = []
+        for bucket in buckets:
+            products = self.bucket_order[
+                self.bucket_starts[bucket] : self.bucket_starts[bucket + 1]
+            ]
+            if brand >= 0:
+                same_brand = self._get_brand_bucket(bucket, brand)
+                candidates.append(same_brand[:k])
+                products = products[: k + len(same_brand)]
+                products = products[self.brands[products] != brand]
+            candidates.append(products[:k])
+        candidates = np.concatenate(candidates) if candidates else self.bucket_order[:0]
+
+        scores = self._get_scores(
+            item_index,
+            candidates,
+            category_scores,
+            total_sales,
+            brand_score_weight,
+            popularity_score_weight,
+        )
+        top = np.lexsort((self.prices[candidates], -scores['score']))[:k]
+        return {
+            'indices': candidates[top],
+            **{name: values[top] for name, values in scores.items()},
+        }
+
+    def get_scores(
+        self,
+        item_index: int,
+        item_indices: np.ndarray,
+        category_score_cutoff: float,
+        brand_score_weight: float,
+        popularity_score_weight: float,
+    ) -> dict[str, np.ndarray]:
+        """Score of some products for an anchor product, and its components, as in get_top_k"""
+        category_scores = self.get_category_scores(item_index)
+        buckets = np.flatnonzero(category_scores >= category_score_cutoff)
+        return self._get_scores(
+            item_index,
+            np.asarray(item_indices),
+            category_scores,
+            self.bucket_sales[buckets].sum(),
+            brand_score_weight,
+            popularity_score_weight,
+        )
+
+    def _get_scores(
+        self,
+        item_index: int,
+        item_indices: np.ndarray,
+        category_scores: np.ndarray,
+        total_sales: float,
+        brand_score_weight: float,
+        popularity_score_weight: float,
+    ) -> dict[str, np.ndarray]:
+        # total_sales: sales of all the products that pass the cutoff
+        brand = self.brands[item_index]
+        brand_scores = (self.brands[item_indices] == brand) & (brand >= 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            popularity_scores = self.sales[item_indices] / total_sales
+        category_scores = category_scores[self.buckets[item_indices]]
+        scores = category_scores * (
+            brand_score_weight * brand_scores
+            + popularity_score_weight * popularity_scores
+        )
+        return {
+            'category_score': category_scores,
+            'brand_score': brand_scores,
+            'popularity_score': popularity_scores,
+            'score': scores,
+        }
+
+    def get_top_k_batch(
+        self,
+        item_indices: np.ndarray,
+        k: int,
+        category_score_cutoff: float,
+        brand_score_weight: float,
+        popularity_score_weight: float,
+        chunk_size: int | None = None,
+    ) -> (np.ndarray, np.ndarray):
+        """
+        Best k products for every anchor product, as get_top_k, in (n_anchors, k) arrays of product indices
+        and scores padded with -1 and NaN. Scores are computed as (anchors x products) matrix operations on
+        the integer category labels and brands, for chunks of chunk_size anchors (by default, as many as fit
+        in about 16M cells).
+        """
+        item_indices = np.asarray(item_indices)
+        n_products = len(self.buckets)
+        chunk_size = chunk_size or max(1, 2**24 // max(n_products, 1))
+        indices = np.full((len(item_indices), k), -1, dtype=np.int32)
+        scores = np.full((len(item_indices), k), np.nan)
+        for start in tqdm(range(0, len(item_indices), chunk_size)):
+            anchors = item_indices[start : start + chunk_size]
+            # Category proximity of every bucket, then of every product
+            anchor_labels = self.bucket_labels[self.buckets[anchors]]
+            levels = anchor_labels >= 0
+            matches = (
+                (anchor_labels[:, None, :] == self.bucket_labels[None, :, :])
+                & levels[:, None, :]
+            ).sum(axis=2)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                bucket_scores = matches / levels.sum(axis=1, keepdims=True)
+            qualifying_buckets = bucket_scores >= category_score_cutoff
+            total_sales = qualifying_buckets @ self.bucket_sales
+            category_scores = bucket_scores[:, self.buckets]
+            qualifying = qualifying_buckets[:, self.buckets]
+            anchor_brands = self.brands[anchors][:, None]
+            brand_scores = (self.brands[None, :] == anchor_brands) & (
+                anchor_brands >= 0
+            )
+            with np.errstate(divide='ignore', invalid='ignore'):
+                popularity_scores = self.sales[None, :] / total_sales[:, None]
+            chunk_scores = category_scores * (
+                brand_score_weight * brand_scores
+                + popularity_score_weight * popularity_scores
+            )
+            # Ascending sort keys: scores first, then qualifying products without score, then the rest
+            keys = np.where(
+                qualifying,
+                np.where(np.isnan(chunk_scores), np.inf, -chunk_scores),
+                np.nan,
+            )
+            n_candidates = min(k, n_products)
+            if n_candidates == 0:
+                continue
+            partition = np.argpartition(keys, n_candidates - 1, axis=1)[
+                :, :n_candidates
+            ]
+            # Products that do not pass the cutoff (NaN) are never candidates, even with less than k others
+            kth_keys = np.fmax.reduce(
+                np.take_along_axis(keys, partition, axis=1), axis=1
+            )
+            for row, anchor_keys in enumerate(keys):
+                # Products tied with the k-th one are all candidates: price breaks ties
+                candidates = np.flatnonzero(anchor_keys <= kth_keys[row])
+                top = candidates[
+                    np.lexsort((self.prices[candidates], anchor_keys[candidates]))[:k]
+                ]
+                indices[start + row, : len(top)] = top
+                scores[start + row, : len(top)] = chunk_scores[row, top]
+        return indices, scores
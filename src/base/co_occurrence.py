@@ -0,0 +1,203 @@
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+
+from base.external_co_occurrence import ExternalCoOccurrence
+from base.sketches import CoOccurrenceSketch
+
+
+def get_co_occurrence_matrix(
+    interactions: sparse.csr_matrix, block_size: int | None = None
+) -> sparse.csr_matrix:
+    """
+    Upper-triangular item co-occurrence matrix of a (users x items) interaction matrix: cell (i, j), i < j,
+    counts the users that interacted with both items.
+
+    It is computed as the sparse product Xᵀ·X of the binary interaction matrix. With block_size, users are
+    processed in blocks of that many rows and the partial products are added up, so peak memory is bounded by
+    the densest block rather than by the whole product.
+    """
+    n_users, n_items = interactions.shape
+    incidence = sparse.csr_matrix(
+        (
+            np.ones(interactions.nnz, dtype=np.int32),
+            interactions.indices,
+            interactions.indptr,
+        ),
+        shape=interactions.shape,
+    )
+    block_size = block_size or max(n_users, 1)
+    co_occurrence = sparse.csr_matrix((n_items, n_items), dtype=np.int32)
+    for start in tqdm(range(0, n_users, block_size)):
+        block = incidence[start : start + block_size]
+        co_occurrence += sparse.triu(block.T @ block, k=1, format='csr')
+    co_occurrence.sum_duplicates()
+    co_occurrence.sort_indices()
+    return co_occurrence
+
+
+def get_symmetric_matrix(co_occurrence: sparse.csr_matrix) -> sparse.csr_matrix:
+    """Full symmetric matrix from an upper-triangular one, so the pairs of an item are a single CSR row"""
+    symmetric = (co_occurrence + co_occurrence.T).tocsr()
+    symmetric.sort_indices()
+    return symmetric
+
+
+def get_top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k highest scores, highest first and lowest position first on ties"""
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        # Scores tied with the k-th one may have been left out arbitrarily: take them all and sort
+        candidates = np.flatnonzero(scores >= scores[candidates].min())
+    else:
+        candidates = np.arange(len(scores))
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order[:k]]
+
+
+def get_row(
+    co_occurrence: sparse.csr_matrix | ExternalCoOccurrence | CoOccurrenceSketch,
+    item_index: int,
+) -> (np.ndarray, np.ndarray):
+    """Indices and values of the non-zero cells of a row, from a CSR matrix in memory, on disk or sketched"""
+    if not isinstance(co_occurrence, sparse.csr_matrix):
+        return co_occurrence.get_row(item_index)
+    start, end = co_occurrence.indptr[item_index : item_index + 2]
+    return co_occurrence.indices[start:end], co_occurrence.data[start:end]
+
+
+def get_top_k_neighbours(
+    co_occurrence: sparse.csr_matrix | ExternalCoOccurrence | CoOccurrenceSketch,
+    item_index: int,
+    k: int,
+    pad: bool = True,
+) -> (np.ndarray, np.ndarray):
+    """
+    Indices and co-occurrence counts of the k items that co-occur the most with item_index, from its row of a
+    symmetric matrix. Items without co-occurrences pad the result in catalogue order, with a count of 0, unless
+    pad is False: then rows with fewer than k non-zero cells return fewer than k items.
+    """
+    neighbours, counts = get_row(co_occurrence, item_index)
+    top = get_top_k(counts, k)
+    neighbours, counts = neighbours[top], counts[top]
+    if not pad:
+        return neighbours, counts
+    n_padding = min(k, co_occurrence.shape[1]) - len(neighbours)
+    if n_padding > 0:
+        padding = np.setdiff1d(
+            np.arange(min(co_occurrence.shape[1], k + len(neighbours))),
+            neighbours,
+            assume_unique=True,
+        )[:n_padding]
+        neighbours = np.concatenate([neighbours, padding])
+        counts = np.concatenate([counts, np.zeros(n_padding, dtype=counts.dtype)])
+    return neighbours, counts
+
+
+similarity_measures = ['jaccard', 'cosine', 'lift']
+
+
+def get_similarity_matrix(
+    interactions: sparse.csr_matrix,
+    measure: str = 'cosine',
+    block_size: int = 1024,
+    threshold: float = 0.0,
+    top_n: int | None = None,
+) -> sparse.csr_matrix:
+    """
+    Item-item similarity matrix of a (users x items) interaction matrix, from co-occurrence counts c_ij and
+    item counts n_i:
+    - jaccard: c_ij / (n_i + n_j - c_ij)
+    - cosine: c_ij / sqrt(n_i * n_j)
+    - lift: c_ij * n_users / (n_i * n_j)
+
+    Rows are computed in blocks of block_size items as Xᵀ[block]·X, and every block is pruned as soon as it
+    is computed: similarities not above threshold are dropped, and only the top_n of every row are kept if
+    given. So only one unpruned block is in memory at a time. Items are not similar to themselves.
+    """
+    if measure not in similarity_measures:
+        raise ValueError(
+            f'Unknown similarity measure {measure}, use one of {similarity_measures}'
+        )
+    n_users, n_items = interactions.shape
+    incidence = sparse.csr_matrix(
+        (
+            np.ones(interactions.nnz, dtype=np.float32),
+            interactions.indices,
+            interactions.indptr,
+        ),
+        shape=interactions.shape,
+    )
+    item_counts = np.bincount(incidence.indices, minlength=n_items).astype(np.float32)
+    incidence_t = incidence.T.tocsr()
+    rows, columns, similarities = [], [], []
+    for start in tqdm(range(0, n_items, block_size)):
+        block = (incidence_t[start : start + block_size] @ incidence).tocoo()
+        block_rows = block.row + start
+        counts = block.data
+        row_counts, column_counts = item_counts[block_rows], item_counts[block.col]
+        if measure == 'jaccard':
+            similarity = counts / (row_counts + column_counts - counts)
+        elif measure == 'cosine':
+            similarity = counts / np.sqrt(row_counts * column_counts)
+        else:
+            similarity = counts * n_users / (row_counts * column_counts)
+        kept = (similarity > threshold) & (block_rows != block.col)
+        block_rows, block_columns, similarity = (
+            block_rows[kept],
+            block.col[kept],
+            similarity[kept],
+        )
+        if top_n is not None:
+            # Rank of every entry within its row, by decreasing similarity
+            order = np.lexsort((-similarity, block_rows))
+            block_rows, block_columns, similarity = (
+                block_rows[order],
+                block_columns[order],
+                similarity[order],
+            )
+            row_starts = np.searchsorted(block_rows, block_rows)
+            kept = np.arange(len(block_rows)) - row_starts < top_n
+            block_rows, block_columns, similarity = (
+                block_rows[kept],
+                block_columns[kept],
+                similarity[kept],
+            )
+        rows.append(block_rows)
+        columns.append(block_columns)
+        similarities.append(similarity.astype(np.float32))
+    similarity_matrix = sparse.csr_matrix(
+        (
+            np.concatenate(similarities),
+            (np.concatenate(rows), np.concatenate(columns)),
+        ),
+        shape=(n_items, n_items),
+    )
+    similarity_matrix.sort_indices()
+    return similarity_matrix
+
+
+def get_co_occurrence_delta(
+    old_interactions: sparse.csr_matrix,
+    new_interactions: sparse.csr_matrix,
+    n_items: int,
+) -> sparse.coo_matrix:
+    """
+    Change in the symmetric co-occurrence counts when some users' rows of the interaction matrix go from
+    old_interactions to new_interactions (same users, in the same order; old rows may have fewer items):
+    X_newᵀ·X_new - X_oldᵀ·X_old, without the diagonal.
+    """
+    old_incidence, new_incidence = (
+        sparse.csr_matrix(
+            (np.ones(rows.nnz, dtype=np.int32), rows.indices, rows.indptr),
+            shape=(rows.shape[0], n_items),
+        )
+        for rows in [old_interactions, new_interactions]
+    )
+    delta = (new_incidence.T @ new_incidence - old_incidence.T @ old_incidence).tocoo()
+    kept = (delta.row != delta.col) & (delta.data != 0)
+    return sparse.coo_matrix(
+        (delta.data[kept], (delta.row[kept], delta.col[kept])), shape=(n_items, n_items)
+    )
@@ -1,11 +1,49 @@
+import itertools
+import json
+import os
 import pickle
 import random
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pandas.api.types import union_categoricals
+from pyarrow import dataset, feather
+from scipy import sparse
+from tqdm import tqdm
+
+from base.categories import CategoryTree
+from base.load_spec import LoadSpec
+from base.sampling import DataSetSampler
 
 
 class DataSet:
     subcategory_depth = 1
+    train_test_split = 0.2
+    # Transactions are kept partitioned by event type in this order, so relevant events (cart and purchase)
+    # are contiguous too. Other event types go after these
+    event_type_order = ['view', 'cart', 'purchase']
+    # Train transactions appended since all_transactions was last read, and the (user position, product index)
+    # pairs whose transactions moved to validation meanwhile. They are merged into all_transactions on its
+    # next read, or once there are max_pending_transactions of them
+    max_pending_transactions = 100_000
+    _pending_transactions: tuple[pd.DataFrame, ...] = ()
+    _pending_moved_pairs: tuple[np.ndarray, ...] = ()
+    # Attributes stored in a dataset directory, and the method that reads each of them
+    _stored_attributes = {
+        'all_transactions': '_read_table',
+        'products': '_read_table',
+        'metrics': '_read_table',
+        'users': '_read_users',
+        'product_to_index': '_read_product_index',
+        'index_to_product': '_read_product_index',
+        'index_product_table': '_read_product_index',
+        'train_interactions': '_read_interactions',
+        'validation_interactions': '_read_interactions',
+        'train_event_counts': '_read_interactions',
+        'validation_event_counts': '_read_interactions',
+    }
 
     @staticmethod
     def from_pickle(file_path='data/shopping/e-commerce_dataset.pickle') -> 'DataSet':
@@ -21,126 +59,1170 @@ class DataSet:
             pickle.dump(self, file)
         print('Done!')
 
+    @staticmethod
+    def from_directory(directory_path='data/shopping/e-commerce_dataset') -> 'DataSet':
+        """
+        Opens a dataset written with to_directory. Tables are memory-mapped and only read on first access, so
+        opening is almost instant and processes reading the same directory share the OS page cache.
+        """
+        print('Opening dataset directory...')
+        with open(os.path.join(directory_path, 'dataset.json')) as file:
+            metadata = json.load(file)
+        loaded_dataset: DataSet = DataSet.__new__(DataSet)
+        loaded_dataset.__dict__.update(metadata['attributes'])
+        loaded_dataset._directory_path = os.path.abspath(directory_path)
+        print('Done!')
+        return loaded_dataset
+
+    def to_directory(self, directory_path='data/shopping/e-commerce_dataset'):
+        """
+        Writes the dataset as a directory of uncompressed Arrow IPC (feather) tables and .npy arrays.
+        """
+        os.makedirs(directory_path, exist_ok=True)
+        print('Writing tables...')
+        for table in ['all_transactions', 'products', 'metrics']:
+            feather.write_feather(
+                getattr(self, table),
+                os.path.join(directory_path, f'{table}.arrow'),
+                compression='uncompressed',
+            )
+        print('Writing users...')
+        # Item lists are stored flat: codes into a table of labels, plus per-user offsets
+        users = self.users
+        items = pd.Series(itertools.chain.from_iterable(users['relevant_items']))
+        item_codes, item_labels = pd.factorize(items)
+        offsets = np.zeros(self.n_users + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(users['n_relevant'].to_numpy())
+        np.save(
+            os.path.join(directory_path, 'users_items.npy'), item_codes.astype(np.int32)
+        )
+        np.save(os.path.join(directory_path, 'users_offsets.npy'), offsets)
+        feather.write_feather(
+            pd.DataFrame({'product_id': item_labels}),
+            os.path.join(directory_path, 'users_item_labels.arrow'),
+            compression='uncompressed',
+        )
+        feather.write_feather(
+            users[['n_relevant', 'validation_n_relevant', 'train_n_relevant']],
+            os.path.join(directory_path, 'users.arrow'),
+            compression='uncompressed',
+        )
+        print('Writing user-item interactions...')
+        for split in ['train', 'validation']:
+            interactions: sparse.csr_matrix = getattr(self, f'{split}_interactions')
+            for array in ['indptr', 'indices', 'data']:
+                np.save(
+                    os.path.join(directory_path, f'{split}_interactions_{array}.npy'),
+                    getattr(interactions, array),
+                )
+            np.save(
+                os.path.join(directory_path, f'{split}_event_counts.npy'),
+                getattr(self, f'{split}_event_counts'),
+            )
+        metadata = {
+            'format_version': 1,
+            'attributes': {
+                'subcategory_depth': self.subcategory_depth,
+                'train_test_split': self.train_test_split,
+                'category_fields': self.category_fields,
+                'event_types': self.event_types,
+            },
+        }
+        with open(os.path.join(directory_path, 'dataset.json'), 'w') as file:
+            json.dump(metadata, file, indent=2)
+        print('Done!')
+
+    def __getattr__(self, name: str):
+        # Only reached for missing attributes: read them from the directory the dataset was opened from
+        directory_path = self.__dict__.get('_directory_path')
+        if directory_path is None or name not in self._stored_attributes:
+            raise AttributeError(
+                f"'{type(self).__name__}' object has no attribute '{name}'"
+            )
+        getattr(self, self._stored_attributes[name])(directory_path, name)
+        return getattr(self, name)
+
+    def __setstate__(self, state: dict):
+        # Pickles from before transactions were partitioned by event type store them as a plain attribute
+        transactions = state.pop('all_transactions', None)
+        self.__dict__.update(state)
+        if transactions is not None:
+            self.all_transactions = transactions
+
+    def _read_table(self, directory_path: str, name: str):
+        table = feather.read_table(
+            os.path.join(directory_path, f'{name}.arrow'), memory_map=True
+        )
+        setattr(self, name, table.to_pandas(split_blocks=True))
+
+    def _read_users(self, directory_path: str, name: str):
+        users = feather.read_table(
+            os.path.join(directory_path, 'users.arrow'), memory_map=True
+        ).to_pandas()
+        item_labels = feather.read_table(
+            os.path.join(directory_path, 'users_item_labels.arrow'), memory_map=True
+        ).column('product_id')
+        item_codes = np.load(
+            os.path.join(directory_path, 'users_items.npy'), mmap_mode='r'
+        )
+        offsets = np.load(
+            os.path.join(directory_path, 'users_offsets.npy'), mmap_mode='r'
+        )
+        items = item_labels.to_numpy()[item_codes]
+        relevant_items = [
+            items[start:end].tolist() for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+        n_validation = users['validation_n_relevant'].to_numpy()
+        users.insert(0, 'relevant_items', relevant_items)
+        users['validation_relevant_items'] = [
+            user_items[:n] for user_items, n in zip(relevant_items, n_validation)
+        ]
+        users['train_relevant_items'] = [
+            user_items[n:] for user_items, n in zip(relevant_items, n_validation)
+        ]
+        self.users = users
+
+    def _read_product_index(self, directory_path: str, name: str):
+        pti, itp, ipt = self._index_products()
+        self.product_to_index = pti
+        self.index_to_product = itp
+        self.index_product_table = ipt
+
+    def _read_interactions(self, directory_path: str, name: str):
+        split = name.split('_')[0]
+        arrays = {
+            array: np.load(
+                os.path.join(directory_path, f'{split}_interactions_{array}.npy'),
+                mmap_mode='r',
+            )
+            for array in ['indptr', 'indices', 'data']
+        }
+        n_users = arrays['indptr'].shape[0] - 1
+        setattr(
+            self,
+            f'{split}_interactions',
+            sparse.csr_matrix(
+                (arrays['data'], arrays['indices'], arrays['indptr']),
+                shape=(n_users, self.n_products),
+                copy=False,
+            ),
+        )
+        setattr(
+            self,
+            f'{split}_event_counts',
+            np.load(
+                os.path.join(directory_path, f'{split}_event_counts.npy'),
+                mmap_mode='r',
+            ),
+        )
+
     def __init__(
         self,
         transactions_parquet_file: str = 'data/shopping/e-commerce.parquet.gzip',
         train_test_split: float = 0.2,
+        streaming: bool = False,
+        batch_size: int = 1_000_000,
+        load_spec: LoadSpec | None = None,
         **kwargs,
     ):
+        """
+        Builds the dataset from a parquet file of transactions. With streaming=True the file is read in record
+        batches of batch_size rows, twice, so the raw events never have to fit in memory at once. A load_spec
+        restricts the columns and transactions that are read from the file.
+        """
+        self.train_test_split = train_test_split
+        transactions = dataset.dataset(transactions_parquet_file, format='parquet')
+        load_spec = load_spec or LoadSpec()
+        columns = load_spec.get_columns(transactions.schema)
+        transactions_filter = load_spec.get_filter(transactions.schema)
+        if streaming:
+            validation_transactions = self._build_streaming(
+                transactions, columns, transactions_filter, train_test_split, batch_size
+            )
+        else:
+            validation_transactions = self._build(
+                transactions, columns, transactions_filter, train_test_split
+            )
+
+        print('Building user-item relations...')
+        pti, itp, ipt = self._index_products()
+        self.product_to_index: dict[str, int] = pti
+        self.index_to_product: dict[int, str] = itp
+        self.index_product_table: pd.DataFrame = ipt
+        train, train_counts = self._get_interactions(self.all_transactions)
+        self.train_interactions: sparse.csr_matrix = train
+        self.train_event_counts: np.ndarray = train_counts
+        validation, validation_counts = self._get_interactions(validation_transactions)
+        self.validation_interactions: sparse.csr_matrix = validation
+        self.validation_event_counts: np.ndarray = validation_counts
+        print('Done!')
+
+    def _build(
+        self,
+        transactions_dataset: dataset.Dataset,
+        columns: list[str] | None,
+        transactions_filter: pc.Expression | None,
+        train_test_split: float,
+    ) -> pd.DataFrame:
         print('Reading transactions file...')
-        transactions: pd.DataFrame = pd.read_parquet(transactions_parquet_file)
+        transactions: pd.DataFrame = transactions_dataset.to_table(
+            columns=columns, filter=transactions_filter
+        ).to_pandas()
 
         print('Labelling dataset...')
-        transactions['product_id'] = 'P-' + transactions['product_id'].astype(str)
-        transactions['user_id'] = 'U-' + transactions['user_id'].astype(str)
-        transactions['user_session'] = 'S-' + transactions['user_session'].astype(str)
-        self.all_transactions: pd.DataFrame = transactions
+        transactions = self._label_ids(transactions)
+        self.event_types: list[str] = sorted(transactions['event_type'].unique())
 
         print("Extracting user's relevant items...")
-        self.users: pd.DataFrame = self._get_users(train_test_split)
+        self.users: pd.DataFrame = self._get_users(transactions, train_test_split)
         print('Separating into train and test...')
-        split = self.all_transactions.apply(
-            lambda row: row['product_id']
-            in self.users.loc[row['user_id'], 'train_relevant_items'],
-            axis=1,
+        product_ids = transactions['product_id'].cat.categories
+        split = self._get_train_split(
+            transactions['user_id'].cat.codes.to_numpy(),
+            transactions['product_id'].cat.codes.to_numpy(),
+            self._get_train_keys(product_ids),
+            len(product_ids),
         )
-        self.all_transactions = self.all_transactions.loc[split]
+        validation_transactions = transactions.loc[
+            ~split, ['user_id', 'product_id', 'event_type']
+        ]
+        transactions = self._drop_unused_ids(transactions.take(np.flatnonzero(split)))
+
+        # Products keep the first row of each duplicate, so read them before partitioning by event type
+        print('Inferring product list...')
+        self.products: pd.DataFrame = self._get_products(transactions)
+        self.all_transactions = transactions
 
         print('Building metrics...')
-        self.metrics: pd.DataFrame = self.purchases.groupby('product_id').agg(
-            sales_count=('product_id', 'count'),
-            total_sales=('price', 'sum'),
+        self.metrics: pd.DataFrame = self._get_metrics()
+        return validation_transactions
+
+    def _build_streaming(
+        self,
+        transactions: dataset.Dataset,
+        columns: list[str] | None,
+        transactions_filter: pc.Expression | None,
+        train_test_split: float,
+        batch_size: int,
+    ) -> pd.DataFrame:
+        # First pass: unique (user, item) pairs in order of first interaction, to split relevant items
+        print("Extracting user's relevant items...")
+        batch_pairs, event_types = [], set()
+        for batch in tqdm(
+            transactions.to_batches(
+                columns=['user_id', 'product_id', 'event_type'],
+                filter=transactions_filter,
+                batch_size=batch_size,
+            )
+        ):
+            events = batch.to_pandas()
+            event_types.update(events['event_type'].unique())
+            batch_pairs.append(events[['user_id', 'product_id']].drop_duplicates())
+        # Pairs of all batches as int64 keys of their user and product codes, deduplicated in a single pass
+        raw_pairs = pd.concat(batch_pairs, ignore_index=True)
+        del batch_pairs
+        user_codes, raw_users = pd.factorize(
+            raw_pairs['user_id'], use_na_sentinel=False
+        )
+        product_codes, raw_products = pd.factorize(
+            raw_pairs['product_id'], use_na_sentinel=False
+        )
+        keys = pd.unique(
+            user_codes.astype(np.int64) * len(raw_products) + product_codes
         )
+        raw_pairs = pd.DataFrame(
+            {
+                'user_id': raw_users[keys // len(raw_products)],
+                'product_id': raw_products[keys % len(raw_products)],
+            }
+        )
+        del user_codes, product_codes, keys
+        pairs = pd.DataFrame(
+            {
+                'user_id': self._encode_ids(raw_pairs['user_id'], 'U-'),
+                'product_id': self._encode_ids(raw_pairs['product_id'], 'P-'),
+            }
+        )
+        self.event_types: list[str] = sorted(event_types)
+        self.users: pd.DataFrame = self._get_users(pairs, train_test_split)
+        user_ids = self._get_raw_ids(raw_pairs['user_id'], pairs['user_id'])
+        product_ids = self._get_raw_ids(raw_pairs['product_id'], pairs['product_id'])
+        user_labels = pairs['user_id'].cat.categories
+        product_labels = pairs['product_id'].cat.categories
+        train_keys = self._get_train_keys(product_labels)
+        del raw_pairs, pairs
+
+        # Second pass: keep train events as compact columns (ID codes and categorical strings), and accumulate
+        # metrics and product candidates as we go
+        print('Separating into train and test...')
+        train_columns, train_positions, validation_events = {}, [], []
+        metrics, product_rows = None, None
+        product_columns = ['category_id', 'category_code', 'brand', 'price']
+        n_read = 0
+        for batch in tqdm(
+            transactions.to_batches(
+                columns=columns, filter=transactions_filter, batch_size=batch_size
+            )
+        ):
+            events = batch.to_pandas(strings_to_categorical=True)
+            users = user_ids.get_indexer(events['user_id'])
+            products = product_ids.get_indexer(events['product_id'])
+            event_type_codes = pd.Categorical(
+                events['event_type'], categories=self.event_types
+            ).codes
+            split = self._get_train_split(users, products, train_keys, len(product_ids))
+            train_positions.append(n_read + np.flatnonzero(split))
+            n_read += len(events)
+            validation_events.append(
+                (users[~split], products[~split], event_type_codes[~split])
+            )
+
+            events = events[split]
+            for column, values in events.items():
+                if column == 'user_id':
+                    values = users[split].astype(np.int32)
+                elif column == 'product_id':
+                    values = products[split].astype(np.int32)
+                elif isinstance(values.dtype, pd.CategoricalDtype):
+                    values = values.array.remove_unused_categories()
+                train_columns.setdefault(column, []).append(values)
+            events = events[['event_type', *product_columns]].assign(
+                product_id=products[split]
+            )
+            purchases = events[events['event_type'] == 'purchase']
+            batch_metrics = purchases.groupby('product_id').agg(
+                sales_count=('product_id', 'count'), total_sales=('price', 'sum')
+            )
+            if metrics is not None:
+                batch_metrics = metrics.add(batch_metrics, fill_value=0)
+            metrics = batch_metrics
+            batch_rows = events[['product_id', *product_columns]].drop_duplicates()
+            batch_rows = batch_rows.assign(
+                **{
+                    column: self._get_objects(values.array)
+                    for column, values in batch_rows.select_dtypes('category').items()
+                }
+            )
+            if product_rows is not None:
+                batch_rows = pd.concat([product_rows, batch_rows], ignore_index=True)
+            product_rows = batch_rows.drop_duplicates(ignore_index=True)
+
+        print('Labelling dataset...')
+        transactions = pd.DataFrame(index=np.concatenate(train_positions))
+        for column in list(train_columns):
+            values = train_columns.pop(column)
+            if column in ['user_id', 'product_id']:
+                labels = user_labels if column == 'user_id' else product_labels
+                values = pd.Categorical.from_codes(
+                    np.concatenate(values), categories=labels
+                ).remove_unused_categories()
+            elif isinstance(values[0], pd.Categorical):
+                values = union_categoricals(values)
+                if column == 'user_session':
+                    values = self._label_codes(values.codes, values.categories, 'S-')
+                elif column != 'event_type':
+                    values = self._get_objects(values)
+            else:
+                values = pd.concat(values).array
+            transactions[column] = values
+        self.all_transactions: pd.DataFrame = transactions
+
+        print('Building metrics...')
+        metrics = metrics.sort_index().astype({'sales_count': 'int64'})
+        metrics.index = pd.Index(product_labels[metrics.index], name='product_id')
+        self.metrics: pd.DataFrame = metrics
 
         print('Inferring product list...')
-        self.products: pd.DataFrame = self._get_products()
+        product_rows = product_rows.assign(
+            product_id=pd.Categorical(
+                product_labels[product_rows['product_id']],
+                categories=transactions['product_id'].cat.categories,
+            )
+        )
+        self.products: pd.DataFrame = self._get_products(product_rows)
 
-        print('Building user-item relations...')
-        pti, itp, ipt = self._index_products()
-        self.product_to_index: dict[str, int] = pti
-        self.index_to_product: dict[int, str] = itp
-        self.index_product_table: pd.DataFrame = ipt
+        users, products, event_types = map(np.concatenate, zip(*validation_events))
+        validation_transactions = pd.DataFrame(
+            {
+                'user_id': pd.Categorical.from_codes(
+                    users, categories=self.users.index
+                ),
+                'product_id': pd.Categorical.from_codes(
+                    products, categories=product_labels
+                ),
+                'event_type': pd.Categorical.from_codes(
+                    event_types, categories=self.event_types
+                ),
+            }
+        )
+        return validation_transactions
+
+    def append_transactions(
+        self,
+        transactions: str | pd.DataFrame,
+        load_spec: LoadSpec | None = None,
+    ) -> np.ndarray:
+        """
+        Absorbs a delta of new transactions (a parquet file or a frame with the raw columns) without rebuilding
+        the dataset. New users and products go after the existing ones, so user positions and product indices
+        stay stable and model matrices can be extended rather than rebuilt.
+
+        New items of a user go after the ones they already had and the split is applied again to the longer
+        list, so some train items may move to validation. Products keep their row and index even if they lose
+        their train transactions. Returns the positions in users of the users in the delta.
+
+        Only the interaction matrix rows of the users in the delta and the metrics of their products are
+        computed again, and the delta's transactions are merged into all_transactions on its next read, so
+        small deltas (see record_events) take about the same time however long the history is.
+        """
+        print('Reading transactions delta...')
+        if isinstance(transactions, pd.DataFrame):
+            delta_dataset = dataset.dataset(
+                pa.Table.from_pandas(transactions, preserve_index=False)
+            )
+        else:
+            delta_dataset = dataset.dataset(transactions, format='parquet')
+        load_spec = load_spec or LoadSpec()
+        delta: pd.DataFrame = delta_dataset.to_table(
+            columns=list(self._get_recorded_transactions()[0].columns),
+            filter=load_spec.get_filter(delta_dataset.schema),
+        ).to_pandas()
+        delta = self._label_ids(delta)
+        self.event_types: list[str] = self.event_types + sorted(
+            set(delta['event_type'].unique()) - set(self.event_types)
+        )
+
+        print("Updating user's relevant items...")
+        n_products = self.n_products
+        moved_pairs = self._append_relevant_items(delta)
+        delta_users = pd.Index(delta['user_id'].unique().astype(str))
+        train_items = self.users.loc[delta_users, 'train_relevant_items'].explode()
+        split = pd.MultiIndex.from_arrays(
+            [delta['user_id'].astype(str), delta['product_id'].astype(str)]
+        ).isin(pd.MultiIndex.from_arrays([train_items.index, train_items.values]))
+        validation_delta = delta.loc[~split, ['user_id', 'product_id', 'event_type']]
+        train_delta = delta.take(np.flatnonzero(split))
+
+        print('Updating product list...')
+        self._append_products(train_delta)
+
+        print('Updating metrics...')
+        moved_pairs = np.stack([moved_pairs // n_products, moved_pairs % n_products])
+        added, moved = (
+            self._get_purchase_metrics(purchases)
+            for purchases in [
+                train_delta[train_delta['event_type'] == 'purchase'],
+                self._get_purchases(moved_pairs),
+            ]
+        )
+        self._update_metrics(added, moved)
+
+        print('Updating transactions...')
+        self._pending_transactions += (train_delta,)
+        self._pending_moved_pairs += (moved_pairs,)
+        if sum(map(len, self._pending_transactions)) >= self.max_pending_transactions:
+            self._merge_pending_transactions()
+
+        print('Updating user-item relations...')
+        user_indices = np.sort(self.users.index.get_indexer(delta_users))
+        moved_keys = moved_pairs[0] * self.n_products + moved_pairs[1]
+        old_train = self._get_matrix_entries('train', user_indices)
+        old_validation = self._get_matrix_entries('validation', user_indices)
+        moved = np.isin(old_train[0], moved_keys)
+        self._splice_interactions(
+            'train',
+            user_indices,
+            *self._merge_interaction_entries(
+                [
+                    (old_train[0][~moved], old_train[1][~moved]),
+                    self._get_interaction_entries(train_delta),
+                ]
+            ),
+        )
+        self._splice_interactions(
+            'validation',
+            user_indices,
+            *self._merge_interaction_entries(
+                [
+                    old_validation,
+                    (old_train[0][moved], old_train[1][moved]),
+                    self._get_interaction_entries(validation_delta),
+                ]
+            ),
+        )
         print('Done!')
+        return user_indices
+
+    def _get_recorded_transactions(self) -> list[pd.DataFrame]:
+        # all_transactions and the pending transactions, without merging them
+        if not self._pending_transactions:
+            return [self.all_transactions]
+        return [self._all_transactions, *self._pending_transactions]
+
+    def _get_purchases(self, pairs: np.ndarray) -> pd.DataFrame:
+        # Product and price of the recorded purchases of some (user position, product index) pairs. Pairs are
+        # looked up in the categories of every frame, so only purchases are scanned
+        user_labels, product_labels = (
+            self.users.index[pairs[0]],
+            self.products.index[pairs[1]],
+        )
+        frames = []
+        for transactions in self._get_recorded_transactions():
+            purchases = transactions[transactions['event_type'] == 'purchase']
+            user_ids, product_ids = (
+                purchases['user_id'].cat,
+                purchases['product_id'].cat,
+            )
+            users = user_ids.categories.get_indexer(user_labels)
+            products = product_ids.categories.get_indexer(product_labels)
+            known = (users >= 0) & (products >= 0)
+            keys = users[known].astype(np.int64) * len(product_ids.categories)
+            selected = self._get_train_split(
+                user_ids.codes,
+                product_ids.codes,
+                keys + products[known],
+                len(product_ids.categories),
+            )
+            frames.append(
+                pd.DataFrame(
+                    {
+                        'product_id': product_ids.categories[
+                            product_ids.codes[selected]
+                        ],
+                        'price': purchases['price'].to_numpy()[selected],
+                    }
+                )
+            )
+        return pd.concat(frames, ignore_index=True)
+
+    def _update_metrics(self, added: pd.DataFrame, removed: pd.DataFrame):
+        # Only the rows of the products whose purchases changed are computed again, on a copy of the metrics
+        changes = added.sub(removed, fill_value=0)
+        if changes.empty:
+            return
+        metrics = self.metrics
+        index = metrics.index
+        new_products = changes.index.difference(index)
+        if len(new_products):
+            index = index.append(new_products)
+            index.name = metrics.index.name
+        rows = index.get_indexer(changes.index)
+        sales_count = np.zeros(len(index), dtype=np.int64)
+        sales_count[: len(metrics)] = metrics['sales_count'].to_numpy()
+        sales_count[rows] += changes['sales_count'].to_numpy().astype(np.int64)
+        total_sales = np.zeros(len(index), dtype=np.float64)
+        total_sales[: len(metrics)] = metrics['total_sales'].to_numpy()
+        total_sales[rows] += changes['total_sales'].to_numpy()
+        metrics = pd.DataFrame(
+            {'sales_count': sales_count, 'total_sales': total_sales}, index=index
+        )
+        if (sales_count[rows] <= 0).any():
+            metrics = metrics[metrics['sales_count'] > 0]
+        self.metrics: pd.DataFrame = metrics
+
+    def _merge_pending_transactions(self):
+        # Appends the pending transactions to all_transactions in a single concatenation, leaving out those of
+        # the pairs that moved to validation since they were recorded. Categorical columns are concatenated as
+        # codes into the categories of the whole dataset
+        transactions = self._all_transactions
+        frames = [transactions, *self._pending_transactions]
+        moved_pairs = np.concatenate(self._pending_moved_pairs, axis=1)
+        self._pending_transactions, self._pending_moved_pairs = (), ()
+        categories = {
+            'event_type': pd.Index(self.event_types),
+            'product_id': self.products.index,
+            'user_id': self.users.index,
+        }
+        if 'user_session' in transactions:
+            sessions = transactions['user_session'].cat.categories
+            new_sessions = pd.Index(
+                np.concatenate(
+                    [frame['user_session'].cat.categories for frame in frames[1:]]
+                )
+            ).difference(sessions)
+            categories['user_session'] = sessions.append(new_sessions)
+        moved_keys = moved_pairs[0] * self.n_products + moved_pairs[1]
+        start = transactions.index.max() + 1 if len(transactions) else 0
+        codes, others = {column: [] for column in categories}, []
+        for i, frame in enumerate(frames):
+            frame_codes = {
+                column: self._get_codes(frame[column], column_categories)
+                for column, column_categories in categories.items()
+            }
+            kept = ~self._get_train_split(
+                frame_codes['user_id'],
+                frame_codes['product_id'],
+                moved_keys,
+                self.n_products,
+            )
+            frame = frame.drop(columns=list(categories))
+            if not kept.all():
+                frame = frame[kept]
+                frame_codes = {
+                    column: column_codes[kept]
+                    for column, column_codes in frame_codes.items()
+                }
+            if i > 0:
+                frame.index = np.arange(start, start + len(frame))
+                start += len(frame)
+            others.append(frame)
+            for column, column_codes in frame_codes.items():
+                codes[column].append(column_codes)
+        merged = pd.concat(others)
+        for column, column_categories in categories.items():
+            merged[column] = pd.Categorical.from_codes(
+                np.concatenate(codes[column]), categories=column_categories
+            )
+        self.all_transactions = merged[list(transactions.columns)]
+
+    @staticmethod
+    def _get_codes(values: pd.Series, categories: pd.Index) -> np.ndarray:
+        # Codes of values in categories, through the categories of values when they are categorical already
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            return pd.Categorical(values, categories=categories).codes
+        # Missing values (code -1) pick the -1 at the end
+        positions = np.append(categories.get_indexer(values.cat.categories), -1)
+        return positions[values.cat.codes.to_numpy()]
+
+    def record_events(self, events: pd.DataFrame) -> np.ndarray:
+        """
+        Online entry point for new events with raw user_id, product_id and event_type. Missing columns are
+        filled in before appending them: product details (and price, for metrics) from the product list,
+        event_time with the current time and no user_session, if the dataset loaded those columns. Events without
+        a session are left out of session extraction. Returns the positions in users of the users in the events.
+        """
+        events = events.copy()
+        transactions = self._get_recorded_transactions()[0]
+        products = self.products.reindex('P-' + events['product_id'].astype(str))
+        for column in ['category_id', 'category_code', 'brand', 'price']:
+            if column not in events:
+                events[column] = products[column].to_numpy()
+        if 'event_time' in transactions and 'event_time' not in events:
+            time_type = transactions['event_time'].dtype
+            now = pd.Timestamp.now(tz=getattr(time_type, 'tz', None))
+            events['event_time'] = now if time_type.kind == 'M' else str(now)
+        if 'user_session' in transactions and 'user_session' not in events:
+            events['user_session'] = None
+        return self.append_transactions(events)
+
+    def _append_relevant_items(self, delta: pd.DataFrame) -> np.ndarray:
+        # New (user, item) pairs of the delta, in order of first interaction
+        users = self.users
+        pairs = delta[['user_id', 'product_id']].drop_duplicates().astype(str)
+        known_items = users.loc[
+            users.index.intersection(pairs['user_id'].unique()), 'relevant_items'
+        ].explode()
+        known = pd.MultiIndex.from_frame(pairs).isin(
+            pd.MultiIndex.from_arrays([known_items.index, known_items.values])
+        )
+        new_items = pairs[~known].groupby('user_id', sort=False)['product_id'].agg(list)
+
+        index = users.index
+        new_users = new_items.index.difference(index, sort=False)
+        if len(new_users):
+            index = index.append(new_users)
+            index.name = users.index.name
+        relevant_items, validation_items, train_items = (
+            np.empty(len(index), dtype=object) for _ in range(3)
+        )
+        relevant_items[: len(users)] = users['relevant_items'].to_numpy()
+        validation_items[: len(users)] = users['validation_relevant_items'].to_numpy()
+        train_items[: len(users)] = users['train_relevant_items'].to_numpy()
+        # Items that were in the train split of their user and now are in validation
+        moved_users, moved_items = [], []
+        positions = index.get_indexer(new_items.index)
+        for position, items in zip(positions, new_items):
+            old_items = relevant_items[position] or []
+            old_n_validation = int(self.train_test_split * len(old_items))
+            items = old_items + items
+            n_validation = int(self.train_test_split * len(items))
+            moved = old_items[old_n_validation:n_validation]
+            moved_users.extend([position] * len(moved))
+            moved_items.extend(moved)
+            relevant_items[position] = items
+            validation_items[position] = items[:n_validation]
+            train_items[position] = items[n_validation:]
+
+        n_relevant = np.zeros(len(index), dtype=np.int64)
+        n_relevant[: len(users)] = users['n_relevant'].to_numpy()
+        n_relevant[positions] = np.fromiter(
+            map(len, relevant_items[positions]), np.int64, len(positions)
+        )
+        validation_n_relevant = (self.train_test_split * n_relevant).astype(int)
+        self.users: pd.DataFrame = pd.DataFrame(
+            {
+                'relevant_items': relevant_items,
+                'n_relevant': n_relevant,
+                'validation_n_relevant': validation_n_relevant,
+                'train_n_relevant': n_relevant - validation_n_relevant,
+                'validation_relevant_items': validation_items,
+                'train_relevant_items': train_items,
+            },
+            index=index,
+        )
+        return np.asarray(moved_users, dtype=np.int64) * self.n_products + (
+            self.products.index.get_indexer(moved_items)
+        )
+
+    def _append_products(self, transactions: pd.DataFrame):
+        product_ids = transactions['product_id'].astype(str)
+        transactions = transactions[~product_ids.isin(self.products.index)]
+        if transactions.empty:
+            return
+        products = self._get_product_rows(transactions)
+        n_products = self.n_products
+        self.products: pd.DataFrame = self._set_category_tree(
+            pd.concat([self.products, products])
+        )
+        for index, product in enumerate(products.index, start=n_products):
+            self.product_to_index[product] = index
+            self.index_to_product[index] = product
+        self.index_product_table: pd.DataFrame = pd.concat(
+            [
+                self.index_product_table,
+                pd.DataFrame(
+                    {
+                        'index': np.arange(n_products, self.n_products),
+                        'product_id': products.index,
+                    }
+                ),
+            ],
+            ignore_index=True,
+        )
+
+    @property
+    def all_transactions(self) -> pd.DataFrame:
+        transactions = self._all_transactions
+        if self._pending_transactions:
+            self._merge_pending_transactions()
+            transactions = self._all_transactions
+        key = (id(transactions), len(transactions))
+        if self._event_partitions_key != key or not self._has_event_codes(
+            transactions['event_type']
+        ):
+            # Rows were added or removed, or event types changed, in place: partition again
+            self.all_transactions = transactions
+        return self._all_transactions
+
+    @all_transactions.setter
+    def all_transactions(self, transactions: pd.DataFrame):
+        # Stable sort by event type (a no-op when already partitioned), keeping the offsets of every type.
+        # Event types are stored as categorical codes in that order
+        event_types = sorted(
+            transactions['event_type'].dropna().unique(), key=self._event_type_position
+        )
+        codes = pd.Categorical(transactions['event_type'], categories=event_types).codes
+        if (np.diff(codes) < 0).any():
+            positions = np.argsort(codes, kind='stable')
+            transactions = transactions.take(positions)
+            codes = codes[positions]
+        offsets = np.searchsorted(codes, np.arange(len(event_types) + 1))
+        self._event_offsets: dict[str, tuple[int, int]] = {
+            event_type: (offsets[i], offsets[i + 1])
+            for i, event_type in enumerate(event_types)
+        }
+        # Codes the partitions were computed from, to detect event types changed in place
+        self._event_codes: np.ndarray = codes.copy()
+        if not self._has_event_codes(transactions['event_type']):
+            transactions = transactions.copy(deep=False)
+            transactions['event_type'] = pd.Categorical.from_codes(
+                codes, categories=event_types
+            )
+        self._all_transactions = transactions
+        self._event_partitions_key = (id(transactions), len(transactions))
+
+    def _has_event_codes(self, event_types: pd.Series) -> bool:
+        return (
+            isinstance(event_types.dtype, pd.CategoricalDtype)
+            and list(event_types.cat.categories) == list(self._event_offsets)
+            and np.array_equal(event_types.cat.codes.to_numpy(), self._event_codes)
+        )
+
+    def _event_type_position(self, event_type: str) -> tuple[int, str]:
+        if event_type in self.event_type_order:
+            return self.event_type_order.index(event_type), event_type
+        return len(self.event_type_order), event_type
+
+    def get_events(self, event_types: list[str]) -> pd.DataFrame:
+        """Transactions of the given event types. Contiguous partitions are returned as a slice, without copies"""
+        transactions = self.all_transactions
+        ranges = sorted(
+            self._event_offsets[event_type]
+            for event_type in event_types
+            if event_type in self._event_offsets
+        )
+        if not ranges:
+            return transactions.iloc[0:0]
+        if all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:])):
+            return transactions.iloc[ranges[0][0] : ranges[-1][1]]
+        return pd.concat([transactions.iloc[start:end] for start, end in ranges])
 
     @property
     def views(self) -> pd.DataFrame:
-        views = self.all_transactions[self.all_transactions['event_type'] == 'view']
+        views = self.get_events(['view'])
         return views
 
     @property
     def purchases(self) -> pd.DataFrame:
-        views = self.all_transactions[self.all_transactions['event_type'] == 'purchase']
+        views = self.get_events(['purchase'])
         return views
 
     @property
     def relevants(self) -> pd.DataFrame:
-        views = self.all_transactions[
-            self.all_transactions['event_type'].isin(['purchase', 'cart'])
-        ]
+        views = self.get_events(['purchase', 'cart'])
         return views
 
-    def _get_products(self) -> pd.DataFrame:
-        products = (
-            self.all_transactions[
-                ['product_id', 'category_id', 'category_code', 'brand', 'price']
-            ]
-            .drop_duplicates()
-            .sort_values(by=['product_id', 'price'], ascending=[True, False])
-        )
-        # Products are often duplicated because of price (transactions are not the best source of this info)
-        dupes = products['product_id'].duplicated()
-        products = products[~dupes]
-        # Expand category into subcategories
-        categories = products['category_code'].str.split('.', expand=True)
-        self.subcategory_depth: int = categories.shape[1]
+    def _get_products(self, transactions: pd.DataFrame) -> pd.DataFrame:
+        return self._set_category_tree(self._get_product_rows(transactions))
+
+    @staticmethod
+    def _get_product_rows(transactions: pd.DataFrame) -> pd.DataFrame:
+        products = transactions[
+            ['product_id', 'category_id', 'category_code', 'brand', 'price']
+        ]
+        # Products are often duplicated because of price (transactions are not the best source of this info):
+        # keep the most expensive row of each product, the first one seen on ties
+        product_codes = products['product_id'].cat.codes.to_numpy()
+        order = np.lexsort((-products['price'].to_numpy(), product_codes))
+        product_codes = product_codes[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = product_codes[1:] != product_codes[:-1]
+        products = products.take(order[first]).set_index('product_id')
+        products.index = products.index.astype(str)
+        return products
+
+    def _set_category_tree(self, products: pd.DataFrame) -> pd.DataFrame:
+        # Expand category into subcategories, integer coded through the category tree
+        category_tree = CategoryTree(products['category_code'])
+        self.subcategory_depth: int = category_tree.depth
         self.category_fields: list[str] = [
             f'category_code_L{i+1}' for i in range(self.subcategory_depth)
         ]
-        categories.columns = self.category_fields
-        products = pd.concat([products, categories], axis=1).set_index('product_id')
+        products = products.drop(
+            columns=[
+                column for column in products if column.startswith('category_code_L')
+            ]
+        ).assign(
+            **{
+                field: category_tree.get_level(level)
+                for level, field in enumerate(self.category_fields)
+            }
+        )
+        self._category_tree = category_tree
+        self._category_tree_key = id(products)
         return products
 
-    def _get_users(self, train_test_split: float) -> pd.DataFrame:
-        users = self.all_transactions.groupby('user_id').agg(
-            relevant_items=('product_id', lambda x: list(x.drop_duplicates()))
+    @property
+    def category_tree(self) -> CategoryTree:
+        """Integer coded category hierarchy of the product list"""
+        if self.__dict__.get('_category_tree_key') != id(self.products):
+            # Products were replaced since the tree was built, or the dataset was loaded without one
+            self._category_tree = CategoryTree(self.products['category_code'])
+            self._category_tree_key = id(self.products)
+        return self._category_tree
+
+    def _get_users(
+        self, transactions: pd.DataFrame, train_test_split: float
+    ) -> pd.DataFrame:
+        # Unique (user, item) pairs, in order of first interaction
+        pairs = transactions[['user_id', 'product_id']].drop_duplicates()
+        users = pairs.groupby('user_id', observed=True).agg(
+            relevant_items=('product_id', list)
         )
+        users.index = users.index.astype(str)
         users['n_relevant'] = users['relevant_items'].apply(len)
         users['validation_n_relevant'] = (
             train_test_split * users['n_relevant']
         ).astype(int)
         users['train_n_relevant'] = users['n_relevant'] - users['validation_n_relevant']
-        users[['validation_relevant_items', 'train_relevant_items']] = users.apply(
-            lambda row: (
-                row['relevant_items'][: row['validation_n_relevant']],
-                row['relevant_items'][row['validation_n_relevant'] :],
+        relevant_items = users['relevant_items'].to_list()
+        n_validation = users['validation_n_relevant'].to_numpy()
+        users['validation_relevant_items'] = [
+            user_items[:n] for user_items, n in zip(relevant_items, n_validation)
+        ]
+        users['train_relevant_items'] = [
+            user_items[n:] for user_items, n in zip(relevant_items, n_validation)
+        ]
+        return users
+
+    def _get_train_keys(self, product_ids: pd.Index) -> np.ndarray:
+        # (user, item) pairs of the train split as single integer keys: user position and product code
+        train_items = self.users['train_relevant_items'].explode().dropna()
+        users = self.users.index.get_indexer(train_items.index).astype(np.int64)
+        products = product_ids.get_indexer(train_items.values)
+        return users * len(product_ids) + products
+
+    @staticmethod
+    def _get_train_split(
+        users: np.ndarray, products: np.ndarray, train_keys: np.ndarray, n_products: int
+    ) -> np.ndarray:
+        # Semi-join of every transaction against the (user, item) pairs of the train split
+        return np.isin(users.astype(np.int64) * n_products + products, train_keys)
+
+    def _get_metrics(self) -> pd.DataFrame:
+        return self._get_purchase_metrics(self.purchases)
+
+    @staticmethod
+    def _get_purchase_metrics(purchases: pd.DataFrame) -> pd.DataFrame:
+        metrics = purchases.groupby('product_id', observed=True).agg(
+            sales_count=('product_id', 'count'),
+            total_sales=('price', 'sum'),
+        )
+        metrics.index = metrics.index.astype(str)
+        return metrics
+
+    def _get_interactions(
+        self, transactions: pd.DataFrame
+    ) -> (sparse.csr_matrix, np.ndarray):
+        pairs, event_counts = self._get_interaction_entries(transactions)
+        return self._build_interactions(pairs, event_counts)
+
+    def _get_interaction_entries(
+        self, transactions: pd.DataFrame
+    ) -> (np.ndarray, np.ndarray):
+        # Positions in users/products for every event, through the categories of each column.
+        # Items that are not in the product list (validation only items) are left out
+        user_ids, product_ids = (
+            transactions['user_id'].cat,
+            transactions['product_id'].cat,
+        )
+        users = self.users.index.get_indexer(user_ids.categories)[user_ids.codes]
+        products = self.products.index.get_indexer(product_ids.categories)[
+            product_ids.codes
+        ]
+        event_types = pd.Categorical(
+            transactions['event_type'], categories=self.event_types
+        ).codes
+        known = products >= 0
+        users, products, event_types = users[known], products[known], event_types[known]
+        # Unique pairs come out sorted by user and then product: the CSR layout
+        n_event_types = len(self.event_types)
+        keys = users.astype(np.int64) * self.n_products + products
+        pairs, pair_indices = np.unique(keys, return_inverse=True)
+        event_counts = np.bincount(
+            pair_indices * n_event_types + event_types,
+            minlength=len(pairs) * n_event_types,
+        ).reshape(len(pairs), n_event_types)
+        return pairs, event_counts.astype(np.int32)
+
+    def _build_interactions(
+        self, pairs: np.ndarray, event_counts: np.ndarray
+    ) -> (sparse.csr_matrix, np.ndarray):
+        # pairs are sorted, unique (user position * n_products + product index) keys
+        indptr = np.zeros(self.n_users + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(
+            np.bincount(pairs // self.n_products, minlength=self.n_users)
+        )
+        interactions = sparse.csr_matrix(
+            (
+                np.ones(len(pairs), dtype=np.int32),
+                (pairs % self.n_products).astype(np.int32),
+                indptr,
             ),
-            axis=1,
-            result_type='expand',
+            shape=(self.n_users, self.n_products),
         )
-        return users
+        return interactions, event_counts
+
+    def _get_matrix_entries(
+        self, split: str, user_indices: np.ndarray
+    ) -> (np.ndarray, np.ndarray):
+        # Entries of the rows of some users (sorted positions) in an interaction matrix, as (user position *
+        # n_products + product index) keys
+        interactions: sparse.csr_matrix = getattr(self, f'{split}_interactions')
+        user_indices = user_indices[user_indices < interactions.shape[0]]
+        starts = interactions.indptr[user_indices]
+        lengths = interactions.indptr[user_indices + 1] - starts
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        entries += np.arange(len(entries))
+        users = np.repeat(user_indices.astype(np.int64), lengths)
+        event_counts = np.asarray(getattr(self, f'{split}_event_counts'))[entries]
+        return (
+            users * self.n_products + interactions.indices[entries],
+            self._pad_event_counts(event_counts),
+        )
+
+    def _pad_event_counts(self, event_counts: np.ndarray) -> np.ndarray:
+        # Zero counts for the event types added after the counts were computed
+        missing = len(self.event_types) - event_counts.shape[1]
+        return np.pad(event_counts, [(0, 0), (0, missing)]) if missing else event_counts
+
+    def _splice_interactions(
+        self,
+        split: str,
+        user_indices: np.ndarray,
+        pairs: np.ndarray,
+        event_counts: np.ndarray,
+    ):
+        # Replaces the rows of some users (sorted positions) in an interaction matrix with pairs, sorted (user
+        # position * n_products + product index) keys of those users. Other rows are copied as they are
+        interactions: sparse.csr_matrix = getattr(self, f'{split}_interactions')
+        lengths = np.zeros(self.n_users, dtype=np.int64)
+        lengths[: interactions.shape[0]] = np.diff(interactions.indptr)
+        kept = np.ones(self.n_users, dtype=bool)
+        kept[user_indices] = False
+        kept_entries = np.repeat(kept, lengths)
+        lengths[user_indices] = 0
+        # Entries of a user go before the kept entries of the users after it
+        users = pairs // self.n_products
+        positions = np.cumsum(lengths)[users]
+        indices = np.insert(
+            interactions.indices[kept_entries], positions, pairs % self.n_products
+        )
+        old_counts = np.asarray(getattr(self, f'{split}_event_counts'))[kept_entries]
+        event_counts = np.insert(
+            self._pad_event_counts(old_counts), positions, event_counts, axis=0
+        )
+        lengths += np.bincount(users, minlength=self.n_users)
+        indptr = np.zeros(self.n_users + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        interactions = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.int32), indices, indptr),
+            shape=(self.n_users, self.n_products),
+        )
+        setattr(self, f'{split}_interactions', interactions)
+        setattr(self, f'{split}_event_counts', event_counts)
+
+    @staticmethod
+    def _merge_interaction_entries(
+        entries: list[tuple[np.ndarray, np.ndarray]]
+    ) -> (np.ndarray, np.ndarray):
+        # Sorted, unique keys, adding up the event counts of repeated ones
+        keys, event_counts = map(np.concatenate, zip(*entries))
+        pairs, pair_indices = np.unique(keys, return_inverse=True)
+        merged = np.zeros((len(pairs), event_counts.shape[1]), dtype=np.int32)
+        np.add.at(merged, pair_indices, event_counts)
+        return pairs, merged
+
+    def interaction_matrix(
+        self, split: str = 'train', weights: dict[str, float] | None = None
+    ) -> sparse.csr_matrix:
+        """
+        User-item matrix of the train or validation split, with rows in users order and columns in
+        product_to_index order. Without weights every relevant item counts as 1; with weights, each entry is
+        the weighted count of the user's events on the item, by event type (e.g. {'view': 1, 'purchase': 5}).
+        """
+        interactions: sparse.csr_matrix = getattr(self, f'{split}_interactions')
+        if weights is None:
+            return interactions
+        event_weights = np.array(
+            [weights.get(event_type, 0) for event_type in self.event_types]
+        )
+        event_counts: np.ndarray = getattr(self, f'{split}_event_counts')
+        return sparse.csr_matrix(
+            (event_counts @ event_weights, interactions.indices, interactions.indptr),
+            shape=interactions.shape,
+            copy=False,
+        )
+
+    def get_user_items(self, user: str, for_validation: bool = False) -> np.ndarray:
+        """Product indices of the user's train (or validation) items, as a view over the interaction matrix"""
+        interactions = self.interaction_matrix(
+            'validation' if for_validation else 'train'
+        )
+        user_index = self.users.index.get_loc(user)
+        start, end = (
+            interactions.indptr[user_index],
+            interactions.indptr[user_index + 1],
+        )
+        return interactions.indices[start:end]
+
+    def _label_ids(self, transactions: pd.DataFrame) -> pd.DataFrame:
+        transactions['product_id'] = self._encode_ids(transactions['product_id'], 'P-')
+        transactions['user_id'] = self._encode_ids(transactions['user_id'], 'U-')
+        if 'user_session' in transactions:
+            # Events without a session stay without one, rather than sharing an 'S-nan' session
+            transactions['user_session'] = self._encode_ids(
+                transactions['user_session'], 'S-', keep_missing=True
+            )
+        return transactions
+
+    @staticmethod
+    def _encode_ids(
+        ids: pd.Series, prefix: str, keep_missing: bool = False
+    ) -> pd.Categorical:
+        codes, uniques = pd.factorize(ids, use_na_sentinel=keep_missing)
+        return DataSet._label_codes(codes, uniques, prefix)
+
+    @staticmethod
+    def _label_codes(
+        codes: np.ndarray, uniques: pd.Index | np.ndarray, prefix: str
+    ) -> pd.Categorical:
+        # Label only the unique values, keeping categories sorted by label so that
+        # categorical codes follow the same order as the label-indexed tables
+        labels = prefix + pd.Index(uniques).astype(str)
+        ids = pd.Categorical.from_codes(codes, categories=labels)
+        return ids.reorder_categories(labels.sort_values())
+
+    @staticmethod
+    def _get_objects(values: pd.Categorical) -> np.ndarray:
+        # Strings read as categorical, as plain objects (None if missing) like the ones read by _build
+        return np.append(values.categories.to_numpy(dtype=object), None)[values.codes]
+
+    @staticmethod
+    def _get_raw_ids(raw_ids: pd.Series, ids: pd.Series) -> pd.Index:
+        # Raw ID values in the order of the categorical codes they were encoded to
+        raw_index = np.empty(len(ids.cat.categories), dtype=raw_ids.dtype)
+        raw_index[ids.cat.codes] = raw_ids
+        return pd.Index(raw_index)
+
+    @staticmethod
+    def _drop_unused_ids(transactions: pd.DataFrame) -> pd.DataFrame:
+        # Keep categorical codes dense after filtering transactions
+        for column in ['product_id', 'user_id', 'user_session']:
+            if column not in transactions:
+                continue
+            transactions[column] = transactions[column].cat.remove_unused_categories()
+        return transactions
+
+    def encode_products(self, product_ids) -> np.ndarray:
+        """Vectorized product label -> index, as in product_to_index (-1 if unknown)"""
+        return self.products.index.get_indexer(product_ids).astype(np.int32)
+
+    def decode_products(self, product_indices) -> np.ndarray:
+        """Vectorized product index -> label, as in index_to_product"""
+        return self.products.index.to_numpy()[product_indices]
+
+    def encode_users(self, user_ids) -> np.ndarray:
+        """Vectorized user label -> position in users (-1 if unknown)"""
+        return self.users.index.get_indexer(user_ids).astype(np.int32)
+
+    def decode_users(self, user_indices) -> np.ndarray:
+        """Vectorized user position in users -> label"""
+        return self.users.index.to_numpy()[user_indices]
+
+    @property
+    def sampler(self) -> DataSetSampler:
+        """Default (unseeded) sampler behind the get_random_* methods"""
+        if '_sampler' not in self.__dict__:
+            self._sampler = DataSetSampler(self)
+        return self._sampler
+
+    def get_sampler(self, seed: int | None = None) -> DataSetSampler:
+        """New sampler with its own, optionally seeded, random generator"""
+        return DataSetSampler(self, seed)
 
     def get_random_product(self) -> pd.Series:
-        product = self.products.sample(n=1).iloc[0]
+        product = self.products.iloc[self.sampler.sample_products(1)[0]]
         return product
 
     def get_random_product_from_user(
         self, user: str, for_validation: bool = False
     ) -> str:
-        prefix = 'train_'
-        if for_validation:
-            prefix = 'validation_'
-        user_items = self.users.loc[user, prefix + 'relevant_items']
-        item = random.choice(user_items)
+        user_index = self.users.index.get_loc(user)
+        item_index = self.sampler.sample_items([user_index], for_validation)[0]
+        if item_index < 0:
+            # Validation items may all be missing from the product list
+            return random.choice(self.users.loc[user, 'validation_relevant_items'])
+        item = self.index_to_product[item_index]
         return item
 
     def get_random_user(
         self, minimum_interactions: int = 10, for_validation: bool = False
     ) -> pd.Series:
-        users = self.users.query(f"n_relevant >= {minimum_interactions}")
-        random_user = users.sample(n=1).iloc[0]
-        if for_validation:
-            while len(random_user['validation_relevant_items']) < 1:
-                random_user = users.sample(n=1).iloc[0]
+        user_index = self.sampler.sample_users(1, minimum_interactions, for_validation)[
+            0
+        ]
+        random_user = self.users.iloc[user_index]
         return random_user
 
     @property
@@ -0,0 +1,216 @@
+import json
+import os
+import shutil
+
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+
+
+class ExternalCoOccurrence:
+    """
+    Symmetric item co-occurrence matrix built out of core and stored on disk as CSR shards of consecutive
+    item rows. Shards are memory-mapped on first access, so only the rows that are read are ever loaded.
+
+    The build never holds more than about max_pairs item pairs in memory:
+    1. Users are processed in blocks, and the pairs of every block are counted with a sparse product. Every
+       block is spilled to disk as a single run of sorted pair keys and counts: shards are ranges of rows,
+       so the pairs of every shard are a contiguous range of the run, found with the shard offsets.
+    2. The runs of every shard are merged batch by batch, adding up the counts of equal keys, and appended
+       to the shard's CSR arrays.
+    """
+
+    def __init__(self, directory_path: str):
+        # Shards are opened lazily, possibly after unpickling in another working directory
+        self.directory_path = os.path.abspath(directory_path)
+        with open(os.path.join(directory_path, 'co_occurrence.json')) as file:
+            metadata = json.load(file)
+        self.shape: tuple[int, int] = tuple(metadata['shape'])
+        self.shard_starts: np.ndarray = np.array(metadata['shard_starts'])
+        self.shard_nnz: list[int] = metadata['shard_nnz']
+        self._shards: dict[int, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+    def __getstate__(self) -> dict:
+        # Memory maps are not pickled: they are opened again on first access
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    @property
+    def nnz(self) -> int:
+        return sum(self.shard_nnz)
+
+    @staticmethod
+    def build(
+        interactions: sparse.csr_matrix,
+        directory_path: str,
+        max_pairs: int = 10_000_000,
+    ) -> 'ExternalCoOccurrence':
+        n_users, n_items = interactions.shape
+        incidence = sparse.csr_matrix(
+            (
+                np.ones(interactions.nnz, dtype=np.int32),
+                interactions.indices,
+                interactions.indptr,
+            ),
+            shape=interactions.shape,
+        )
+        # Every user with m items generates m * (m - 1) pairs, m - 1 in the row of each of their items
+        user_items = np.diff(incidence.indptr).astype(np.int64)
+        user_pairs = user_items * np.maximum(user_items - 1, 0)
+        item_pairs = np.bincount(
+            incidence.indices,
+            weights=np.repeat(np.maximum(user_items - 1, 0), user_items),
+            minlength=n_items,
+        )
+        shard_starts = ExternalCoOccurrence._split(item_pairs, max_pairs)
+        user_blocks = ExternalCoOccurrence._split(user_pairs, max_pairs)
+        os.makedirs(directory_path, exist_ok=True)
+        runs_path = os.path.join(directory_path, 'runs')
+        # Clear the runs left by an interrupted build
+        shutil.rmtree(runs_path, ignore_errors=True)
+        os.makedirs(runs_path)
+
+        print('Spilling sorted runs of item pairs...')
+        run_dtype = np.dtype([('key', np.int64), ('count', np.int32)])
+        run_offsets = []
+        for run, (user_start, user_end) in enumerate(
+            tqdm(list(zip(user_blocks[:-1], user_blocks[1:])))
+        ):
+            block = incidence[user_start:user_end]
+            pairs = (block.T.tocsr() @ block).tocoo()
+            kept = pairs.row != pairs.col
+            keys = pairs.row[kept].astype(np.int64) * n_items + pairs.col[kept]
+            order = np.argsort(keys, kind='stable')
+            records = np.empty(len(keys), dtype=run_dtype)
+            records['key'] = keys[order]
+            records['count'] = pairs.data[kept][order]
+            np.save(os.path.join(runs_path, f'run_{run}.npy'), records)
+            # Start of every shard's pairs in the run
+            run_offsets.append(
+                np.searchsorted(records['key'], shard_starts.astype(np.int64) * n_items)
+            )
+
+        print('Merging runs into CSR shards...')
+        runs = [
+            np.load(os.path.join(runs_path, f'run_{run}.npy'), mmap_mode='r')
+            for run in range(len(run_offsets))
+        ]
+        shard_nnz = []
+        for shard, (start, end) in enumerate(
+            tqdm(list(zip(shard_starts[:-1], shard_starts[1:])))
+        ):
+            shard_runs = [
+                (
+                    records['key'][offsets[shard] : offsets[shard + 1]],
+                    records['count'][offsets[shard] : offsets[shard + 1]],
+                )
+                for records, offsets in zip(runs, run_offsets)
+                if offsets[shard + 1] > offsets[shard]
+            ]
+            shard_nnz.append(
+                ExternalCoOccurrence._merge_runs(
+                    shard_runs,
+                    os.path.join(directory_path, f'shard_{shard}'),
+                    start,
+                    end,
+                    n_items,
+                    max(max_pairs // max(len(shard_runs), 1), 1),
+                )
+            )
+        del runs
+        shutil.rmtree(runs_path)
+        metadata = {
+            'shape': [n_items, n_items],
+            'shard_starts': shard_starts.tolist(),
+            'shard_nnz': shard_nnz,
+        }
+        with open(os.path.join(directory_path, 'co_occurrence.json'), 'w') as file:
+            json.dump(metadata, file, indent=2)
+        print('Done!')
+        return ExternalCoOccurrence(directory_path)
+
+    @staticmethod
+    def _split(loads: np.ndarray, max_load: int) -> np.ndarray:
+        # Boundaries of consecutive ranges with a total load of about max_load (at least one element each)
+        cumulative_load = np.cumsum(loads)
+        boundaries = np.searchsorted(
+            cumulative_load,
+            np.arange(max_load, cumulative_load[-1] if len(loads) else 0, max_load),
+            side='right',
+        )
+        return np.unique(np.concatenate([[0], boundaries, [len(loads)]]))
+
+    @staticmethod
+    def _merge_runs(
+        runs: list[tuple[np.ndarray, np.ndarray]],
+        shard_path: str,
+        start: int,
+        end: int,
+        n_items: int,
+        batch_size: int,
+    ) -> int:
+        # Batched k-way merge: every step takes the keys of all runs up to the smallest of their batch ends,
+        # which are all the keys that can come before the next step's ones
+        row_counts = np.zeros(end - start, dtype=np.int64)
+        positions = [0] * len(runs)
+        nnz = 0
+        with open(f'{shard_path}_indices.bin', 'wb') as indices_file, open(
+            f'{shard_path}_data.bin', 'wb'
+        ) as data_file:
+            while any(
+                position < len(keys) for position, (keys, _) in zip(positions, runs)
+            ):
+                frontier = min(
+                    keys[min(position + batch_size, len(keys)) - 1]
+                    for position, (keys, _) in zip(positions, runs)
+                    if position < len(keys)
+                )
+                batch_keys, batch_counts = [], []
+                for run, (keys, counts) in enumerate(runs):
+                    position = positions[run]
+                    run_end = position + np.searchsorted(
+                        keys[position:], frontier, side='right'
+                    )
+                    batch_keys.append(keys[position:run_end])
+                    batch_counts.append(counts[position:run_end])
+                    positions[run] = run_end
+                keys, key_indices = np.unique(
+                    np.concatenate(batch_keys), return_inverse=True
+                )
+                counts = np.bincount(
+                    key_indices, weights=np.concatenate(batch_counts)
+                ).astype(np.int32)
+                row_counts += np.bincount(
+                    keys // n_items - start, minlength=end - start
+                )
+                indices_file.write((keys % n_items).astype(np.int32).tobytes())
+                data_file.write(counts.tobytes())
+                nnz += len(keys)
+        indptr = np.zeros(end - start + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(row_counts)
+        np.save(f'{shard_path}_indptr.npy', indptr)
+        return nnz
+
+    def _get_shard(self, shard: int) -> (np.ndarray, np.ndarray, np.ndarray):
+        if shard not in self._shards:
+            shard_path = os.path.join(self.directory_path, f'shard_{shard}')
+            nnz = self.shard_nnz[shard]
+            self._shards[shard] = (
+                np.load(f'{shard_path}_indptr.npy', mmap_mode='r'),
+                *(
+                    np.memmap(f'{shard_path}_{array}.bin', dtype=np.int32, mode='r')
+                    if nnz
+                    else np.empty(0, dtype=np.int32)
+                    for array in ['indices', 'data']
+                ),
+            )
+        return self._shards[shard]
+
+    def get_row(self, item_index: int) -> (np.ndarray, np.ndarray):
+        """Indices and co-occurrence counts of the items that co-occur with item_index, sorted by index"""
+        shard = np.searchsorted(self.shard_starts, item_index, side='right') - 1
+        indptr, indices, data = self._get_shard(shard)
+        row = item_index - self.shard_starts[shard]
+        start, end = indptr[row], indptr[row + 1]
+        return np.asarray(indices[start:end]), np.asarray(data[start:end])
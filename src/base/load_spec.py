@@ -0,0 +1,78 @@
+from dataclasses import dataclass
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+@dataclass
+class LoadSpec:
+    """
+    Declarative description of the transactions to load into a DataSet: which columns, which event types, a
+    date range on event_time ([start_time, end_time)) and a category_code prefix.
+
+    It is pushed down to the pyarrow dataset scanner, so row groups and columns that are not needed are never
+    decoded.
+    """
+
+    columns: list[str] | None = None
+    event_types: list[str] | None = None
+    start_time: str | pd.Timestamp | None = None
+    end_time: str | pd.Timestamp | None = None
+    category_prefix: str | None = None
+
+    # Columns every DataSet needs to build users, products and metrics
+    required_columns = [
+        'event_type',
+        'product_id',
+        'category_id',
+        'category_code',
+        'brand',
+        'price',
+        'user_id',
+    ]
+
+    def get_columns(self, schema: pa.Schema) -> list[str] | None:
+        if self.columns is None:
+            return None
+        columns = set(self.columns) | set(self.required_columns)
+        return [name for name in schema.names if name in columns]
+
+    def get_filter(self, schema: pa.Schema) -> pc.Expression | None:
+        conditions = []
+        if self.event_types is not None:
+            conditions.append(pc.field('event_type').isin(self.event_types))
+        if self.start_time is not None:
+            start_time = self._get_time_scalar(
+                self.start_time, schema.field('event_time').type
+            )
+            conditions.append(pc.field('event_time') >= start_time)
+        if self.end_time is not None:
+            end_time = self._get_time_scalar(
+                self.end_time, schema.field('event_time').type
+            )
+            conditions.append(pc.field('event_time') < end_time)
+        if self.category_prefix is not None:
+            conditions.append(
+                pc.starts_with(pc.field('category_code'), pattern=self.category_prefix)
+            )
+        if not conditions:
+            return None
+        expression = conditions[0]
+        for condition in conditions[1:]:
+            expression = expression & condition
+        return expression
+
+    @staticmethod
+    def _get_time_scalar(
+        value: str | pd.Timestamp, time_type: pa.DataType
+    ) -> pa.Scalar:
+        # Event times may be stored as timestamps (with or without time zone) or as ISO formatted strings
+        if not pa.types.is_timestamp(time_type):
+            return pa.scalar(str(value), type=time_type)
+        value = pd.Timestamp(value)
+        if time_type.tz is not None and value.tz is None:
+            value = value.tz_localize(time_type.tz)
+        elif time_type.tz is None and value.tz is not None:
+            value = value.tz_convert('UTC').tz_localize(None)
+        return pa.scalar(value.to_pydatetime(), type=time_type)
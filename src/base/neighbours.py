@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+
+
+class NeighbourTable:
+    """
+    Precomputed top-N neighbours of every product: an (n_products, N) int32 array of product indices and an
+    (n_products, N) float32 array of scores, best first. Rows with fewer than N neighbours are padded with -1.
+
+    Tables are saved as .npy files and memory-mapped on load, so serving processes share them through the OS
+    page cache and a lookup is a single row read.
+    """
+
+    def __init__(self, indices: np.ndarray, scores: np.ndarray):
+        self.indices: np.ndarray = indices
+        self.scores: np.ndarray = scores
+
+    @staticmethod
+    def load(directory_path: str) -> 'NeighbourTable':
+        return NeighbourTable(
+            np.load(os.path.join(directory_path, 'indices.npy'), mmap_mode='r'),
+            np.load(os.path.join(directory_path, 'scores.npy'), mmap_mode='r'),
+        )
+
+    def save(self, directory_path: str):
+        os.makedirs(directory_path, exist_ok=True)
+        np.save(os.path.join(directory_path, 'indices.npy'), self.indices)
+        np.save(os.path.join(directory_path, 'scores.npy'), self.scores)
+
+    @property
+    def n_neighbours(self) -> int:
+        return self.indices.shape[1]
+
+    def set_rows(
+        self,
+        item_indices: np.ndarray,
+        neighbours: list[tuple[np.ndarray, np.ndarray] | None],
+        n_products: int,
+    ):
+        """
+        Replaces the rows of some products (None leaves a row empty), growing the table to n_products rows.
+        Memory-mapped tables are read-only, so the first update copies them to memory.
+        """
+        if len(self.indices) < n_products or not self.indices.flags.writeable:
+            indices = np.full((n_products, self.n_neighbours), -1, dtype=np.int32)
+            scores = np.full((n_products, self.n_neighbours), np.nan, dtype=np.float32)
+            indices[: len(self.indices)] = self.indices
+            scores[: len(self.scores)] = self.scores
+            self.indices, self.scores = indices, scores
+        for item_index, item_neighbours in zip(item_indices, neighbours):
+            self.indices[item_index] = -1
+            self.scores[item_index] = np.nan
+            if item_neighbours is None:
+                continue
+            items, item_scores = item_neighbours
+            self.indices[item_index, : len(items)] = items
+            self.scores[item_index, : len(items)] = item_scores
+
+    def get(self, item_index: int, k: int) -> tuple[np.ndarray, np.ndarray] | None:
+        """
+        Indices and scores of the k best neighbours of a product, or None when the table cannot answer: unknown
+        product, k larger than the table or no neighbours stored for the product.
+        """
+        if not 0 <= item_index < len(self.indices) or k > self.n_neighbours:
+            return None
+        indices = self.indices[item_index, :k]
+        n_found = np.count_nonzero(indices >= 0)
+        if n_found == 0:
+            return None
+        return np.asarray(indices[:n_found]), np.asarray(
+            self.scores[item_index, :n_found]
+        )
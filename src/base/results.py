@@ -15,7 +15,10 @@ class Results:
         return self.matches.iloc[: min(k, self.n_recommendations)]
 
     def _match_kth_recommendation(self, k: int) -> int:
-        return self.matches.iloc[min(k - 1, self.n_recommendations)]
+        # Models may return fewer than k recommendations: the missing ones are not matches
+        if k > self.n_recommendations:
+            return 0
+        return self.matches.iloc[k - 1]
 
     def recall_at_k(self, k: int) -> float:
         relevant_recommendations = self._matches_first_k_recommendations(k).sum()
@@ -23,14 +26,16 @@ class Results:
 
     def precision_at_k(self, k: int) -> float:
         relevant_recommendations = self._matches_first_k_recommendations(k).sum()
-        return relevant_recommendations / min(k, self.n_recommendations)
+        return relevant_recommendations / max(min(k, self.n_recommendations), 1)
 
     def average_precision_at_k(self, k: int) -> float:
         instances = [
             self.precision_at_k(i + 1) * self._match_kth_recommendation(i + 1)
             for i in range(k)
         ]
-        return sum(instances) / min(self.n_relevant_items, self.n_recommendations)
+        return sum(instances) / max(
+            min(self.n_relevant_items, self.n_recommendations), 1
+        )
 
     def hit_rate_at_k(self, k: int) -> int:
         return int(self._matches_first_k_recommendations(k).any())
@@ -0,0 +1,72 @@
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from base.dataset import DataSet
+
+
+class DataSetSampler:
+    """
+    Batched, seedable sampling of users, products and user items from a DataSet.
+
+    Eligible users are computed once per (minimum_interactions, for_validation) and every draw is a single
+    vectorized call on a numpy Generator, so evaluation loops can sample all their prompts up front.
+    """
+
+    def __init__(self, dataset: 'DataSet', seed: int | None = None):
+        self.dataset = dataset
+        self.rng = np.random.default_rng(seed)
+        self._users = None
+        self._eligible_users: dict[tuple[int, bool], np.ndarray] = {}
+
+    def eligible_users(
+        self, minimum_interactions: int = 10, for_validation: bool = False
+    ) -> np.ndarray:
+        """Positions in dataset.users of the users with enough interactions (and validation items, if asked)"""
+        if self._users is not self.dataset.users:
+            # Users changed since the last call: eligible users have to be computed again
+            self._users = self.dataset.users
+            self._eligible_users = {}
+        key = (minimum_interactions, for_validation)
+        if key not in self._eligible_users:
+            eligible = self._users['n_relevant'].to_numpy() >= minimum_interactions
+            if for_validation:
+                eligible &= self._users['validation_n_relevant'].to_numpy() >= 1
+            self._eligible_users[key] = np.flatnonzero(eligible).astype(np.int32)
+        return self._eligible_users[key]
+
+    def sample_users(
+        self,
+        n_users: int,
+        minimum_interactions: int = 10,
+        for_validation: bool = False,
+    ) -> np.ndarray:
+        """Positions in dataset.users of n_users users drawn uniformly, with replacement, among the eligible ones"""
+        eligible = self.eligible_users(minimum_interactions, for_validation)
+        if len(eligible) == 0:
+            raise ValueError(
+                f'No users with at least {minimum_interactions} relevant items'
+                + (' and validation items' if for_validation else '')
+            )
+        return eligible[self.rng.integers(len(eligible), size=n_users)]
+
+    def sample_items(
+        self, user_indices: np.ndarray, for_validation: bool = False
+    ) -> np.ndarray:
+        """
+        One product index drawn uniformly from the train (or validation) items of every user, or -1 for users
+        without items in the interaction matrix.
+        """
+        split = 'validation' if for_validation else 'train'
+        interactions = self.dataset.interaction_matrix(split)
+        user_indices = np.asarray(user_indices)
+        starts = interactions.indptr[user_indices]
+        lengths = interactions.indptr[user_indices + 1] - starts
+        offsets = (self.rng.random(len(user_indices)) * lengths).astype(np.int64)
+        items = interactions.indices[np.minimum(starts + offsets, interactions.nnz - 1)]
+        return np.where(lengths > 0, items, -1)
+
+    def sample_products(self, n_products: int) -> np.ndarray:
+        """Product indices drawn uniformly, with replacement, from the whole product list"""
+        return self.rng.integers(self.dataset.n_products, size=n_products)
@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from base.dataset import DataSet
+
+
+class Sessions:
+    """
+    Browsing sessions as a flat array of product indices (tokens) plus offsets: session i is
+    tokens[offsets[i]:offsets[i + 1]]. Iterating yields every session as a list of product labels, which is
+    what gensim trains on, so the sessions can be iterated as many times as needed.
+
+    Saved sessions are memory-mapped on load and streamed block_size sessions at a time, so iterating over
+    them takes the same memory however long the history is. They are pickled as their absolute directory
+    path alone, and unpickled sessions only read their arrays on first use.
+    """
+
+    block_size = 10_000
+
+    def __init__(
+        self,
+        offsets: np.ndarray,
+        tokens: np.ndarray,
+        labels: np.ndarray,
+        directory_path: str | None = None,
+    ):
+        self.offsets: np.ndarray = offsets
+        self.tokens: np.ndarray = tokens
+        # Product label of every product index
+        self.labels: np.ndarray = labels
+        self.directory_path = directory_path
+
+    def __getstate__(self) -> dict:
+        if self.directory_path is None:
+            return self.__dict__.copy()
+        return {'directory_path': self.directory_path}
+
+    def __getattr__(self, name: str):
+        # Only reached for missing attributes: memory-map the arrays of saved sessions on first use
+        directory_path = self.__dict__.get('directory_path')
+        if directory_path is None or name not in ['offsets', 'tokens', 'labels']:
+            raise AttributeError(
+                f"'{type(self).__name__}' object has no attribute '{name}'"
+            )
+        self.__dict__.update(Sessions.load(directory_path).__dict__)
+        return self.__dict__[name]
+
+    @staticmethod
+    def load(directory_path: str) -> 'Sessions':
+        directory_path = os.path.abspath(directory_path)
+        return Sessions(
+            *(
+                np.load(os.path.join(directory_path, f'{array}.npy'), mmap_mode='r')
+                for array in ['offsets', 'tokens', 'labels']
+            ),
+            directory_path=directory_path,
+        )
+
+    def save(self, directory_path: str) -> 'Sessions':
+        """Writes the sessions to directory_path and returns them memory-mapped from there"""
+        os.makedirs(directory_path, exist_ok=True)
+        np.save(os.path.join(directory_path, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(directory_path, 'tokens.npy'), self.tokens)
+        # Fixed-width strings, so labels are memory-mapped too
+        np.save(os.path.join(directory_path, 'labels.npy'), self.labels.astype(np.str_))
+        return Sessions.load(directory_path)
+
+    @staticmethod
+    def extract(
+        dataset: DataSet, min_length: int = 2, session_ids: pd.Index | None = None
+    ) -> 'Sessions':
+        """
+        Products of every session of the dataset (or only those in session_ids) in order of first event,
+        without repetitions, keeping the sessions with at least min_length products.
+        """
+        transactions = dataset.all_transactions
+        sessions = transactions['user_session'].cat.codes.to_numpy()
+        product_ids = transactions['product_id'].cat
+        products = dataset.products.index.get_indexer(product_ids.categories)
+        tokens = np.where(
+            product_ids.codes >= 0, products[product_ids.codes], -1
+        ).astype(np.int32)
+        event_times = transactions['event_time'].to_numpy()
+        selected = (sessions >= 0) & (tokens >= 0)
+        if session_ids is not None:
+            selected &= transactions['user_session'].isin(session_ids).to_numpy()
+        kept = np.flatnonzero(selected)
+        order = kept[np.lexsort((event_times[kept], sessions[kept]))]
+        sessions, tokens = sessions[order], tokens[order]
+
+        # First event of every (session, product) pair
+        _, first = np.unique(
+            sessions.astype(np.int64) * dataset.n_products + tokens, return_index=True
+        )
+        first.sort()
+        sessions, tokens = sessions[first], tokens[first]
+
+        starts = np.flatnonzero(np.diff(sessions)) + 1
+        offsets = np.concatenate([[0], starts, [len(sessions)]]).astype(np.int64)
+        lengths = np.diff(offsets)
+        long_enough = lengths >= min_length
+        tokens = tokens[np.repeat(long_enough, lengths)]
+        offsets = np.zeros(np.count_nonzero(long_enough) + 1, dtype=np.int64)
+        np.cumsum(lengths[long_enough], out=offsets[1:])
+        return Sessions(offsets, tokens, dataset.products.index.to_numpy())
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, session: int) -> list[str]:
+        start, end = self.offsets[session], self.offsets[session + 1]
+        return self.labels[self.tokens[start:end]].tolist()
+
+    def __iter__(self):
+        # Tokens are read and turned into labels a block of sessions at a time
+        for start in range(0, len(self), self.block_size):
+            offsets = np.array(self.offsets[start : start + self.block_size + 1])
+            words = self.labels[np.asarray(self.tokens[offsets[0] : offsets[-1]])]
+            words = words.tolist()
+            offsets -= offsets[0]
+            for session_start, session_end in zip(offsets[:-1], offsets[1:]):
+                yield words[session_start:session_end]
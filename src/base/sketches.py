@@ -0,0 +1,201 @@
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+
+
+class CountMinSketch:
+    """
+    Count-Min sketch of integer keys: a (depth, width) table of counters, one hash function per row.
+    Estimates never fall below the true count, and exceed it by at most epsilon * (total count) with
+    probability 1 - delta.
+    """
+
+    def __init__(self, epsilon: float = 1e-5, delta: float = 1e-3, seed: int = 0):
+        self.epsilon = epsilon
+        self.delta = delta
+        # Width is rounded up to a power of two for multiply-shift hashing
+        self.log_width: int = max(int(np.ceil(np.log2(np.e / epsilon))), 1)
+        self.depth: int = max(int(np.ceil(np.log(1 / delta))), 1)
+        rng = np.random.default_rng(seed)
+        self._multipliers = rng.integers(
+            1, 2**63, size=self.depth, dtype=np.uint64
+        ) | np.uint64(1)
+        self._increments = rng.integers(0, 2**63, size=self.depth, dtype=np.uint64)
+        self.table: np.ndarray = np.zeros((self.depth, 2**self.log_width), np.int64)
+        self.total: int = 0
+
+    def _hash(self, keys: np.ndarray, row: int) -> np.ndarray:
+        with np.errstate(over='ignore'):
+            hashed = keys.astype(np.uint64) * self._multipliers[row]
+            hashed += self._increments[row]
+        return (hashed >> np.uint64(64 - self.log_width)).astype(np.int64)
+
+    def add(self, keys: np.ndarray, counts: np.ndarray):
+        width = self.table.shape[1]
+        for row in range(self.depth):
+            self.table[row] += np.bincount(
+                self._hash(keys, row), weights=counts, minlength=width
+            ).astype(np.int64)
+        self.total += int(counts.sum())
+
+    def estimate(self, keys: np.ndarray) -> np.ndarray:
+        return np.min(
+            [self.table[row, self._hash(keys, row)] for row in range(self.depth)],
+            axis=0,
+        )
+
+    @property
+    def error_bound(self) -> float:
+        """Maximum overestimation of any count, with probability 1 - delta"""
+        return self.epsilon * self.total
+
+
+class CoOccurrenceSketch:
+    """
+    Approximate symmetric item co-occurrence in fixed memory: a Count-Min sketch of the counts of every pair,
+    plus the n_neighbours heaviest co-occurring items of every item (heavy hitters), with their estimated
+    counts. Every pair is counted once in the sketch, keyed by (i, j) with i < j, and is a candidate
+    neighbour of both items.
+
+    Users are streamed in blocks. The candidates of the items a block touched are the union of their previous
+    heavy hitters and the block's pairs, re-ranked by their sketch estimates. While building, the pairs of
+    several blocks are buffered and re-ranked together, up to as many pairs as heavy hitters are kept.
+
+    Estimates exceed true counts by at most epsilon * (total pair count) with probability 1 - delta, see
+    error_bound. Heavy hitters are only told apart from the rest when that bound is well below their counts:
+    with the default epsilon = 1e-5 (2^19 counters per row, about 30 MB) it is 10 for every million pairs
+    counted, so long histories need a smaller epsilon, at about 3 / epsilon counters per row.
+    """
+
+    # Pair keys: first item in the high bits, second item in the low ones
+    _key_bits = 32
+    _key_mask = (1 << _key_bits) - 1
+
+    def __init__(
+        self,
+        n_items: int,
+        n_neighbours: int = 100,
+        epsilon: float = 1e-5,
+        delta: float = 1e-3,
+        seed: int = 0,
+    ):
+        self.shape: tuple[int, int] = (n_items, n_items)
+        self.sketch = CountMinSketch(epsilon, delta, seed)
+        self.neighbours: np.ndarray = np.full((n_items, n_neighbours), -1, np.int32)
+        self.counts: np.ndarray = np.zeros((n_items, n_neighbours), np.int64)
+
+    @staticmethod
+    def build(
+        interactions: sparse.csr_matrix,
+        n_neighbours: int = 100,
+        epsilon: float = 1e-5,
+        delta: float = 1e-3,
+        block_size: int = 10_000,
+        seed: int = 0,
+    ) -> 'CoOccurrenceSketch':
+        co_occurrence = CoOccurrenceSketch(
+            interactions.shape[1], n_neighbours, epsilon, delta, seed
+        )
+        incidence = sparse.csr_matrix(
+            (
+                np.ones(interactions.nnz, dtype=np.int32),
+                interactions.indices,
+                interactions.indptr,
+            ),
+            shape=interactions.shape,
+        )
+        pending, n_pending = [], 0
+        for start in tqdm(range(0, interactions.shape[0], block_size)):
+            block = incidence[start : start + block_size]
+            pending.append(co_occurrence._count_pairs(block.T @ block))
+            n_pending += len(pending[-1])
+            if n_pending >= co_occurrence.neighbours.size:
+                co_occurrence._update_neighbours(np.unique(np.concatenate(pending)))
+                pending, n_pending = [], 0
+        # Estimates only grow: rank every item's heavy hitters with the final ones
+        co_occurrence._update_neighbours(
+            np.unique(np.concatenate(pending or [np.empty(0, np.int64)])),
+            np.arange(co_occurrence.shape[0]),
+        )
+        return co_occurrence
+
+    def resize(self, n_items: int):
+        """Makes room for items added to the catalogue"""
+        old_items, n_neighbours = self.neighbours.shape
+        if n_items <= old_items:
+            return
+        self.neighbours = np.concatenate(
+            [
+                self.neighbours,
+                np.full((n_items - old_items, n_neighbours), -1, np.int32),
+            ]
+        )
+        self.counts = np.concatenate(
+            [self.counts, np.zeros((n_items - old_items, n_neighbours), np.int64)]
+        )
+        self.shape = (n_items, n_items)
+
+    def add(self, pairs: sparse.spmatrix):
+        """Adds a symmetric (items x items) matrix of pair counts, ignoring its diagonal"""
+        self._update_neighbours(self._count_pairs(pairs))
+
+    def _count_pairs(self, pairs: sparse.spmatrix) -> np.ndarray:
+        # Adds the pairs to the sketch and returns their keys
+        pairs = pairs.tocoo()
+        kept = pairs.row < pairs.col
+        # Keys do not depend on the number of items, so the catalogue can grow
+        keys = (pairs.row[kept].astype(np.int64) << self._key_bits) + pairs.col[kept]
+        self.sketch.add(keys, pairs.data[kept].astype(np.int64))
+        return keys
+
+    def _update_neighbours(self, keys: np.ndarray, items: np.ndarray | None = None):
+        # Re-ranks the heavy hitters of items (by default those in the pairs of keys)
+        n_neighbours = self.neighbours.shape[1]
+        # Pairs are keyed once, with i < j: mirror them so they are candidates of both items
+        pair_items = np.concatenate([keys >> self._key_bits, keys & self._key_mask])
+        pair_neighbours = np.concatenate(
+            [keys & self._key_mask, keys >> self._key_bits]
+        )
+        if items is None:
+            items = np.unique(pair_items)
+        neighbours = self.neighbours[items]
+        known = neighbours >= 0
+        candidates = np.unique(
+            (
+                np.concatenate(
+                    [np.repeat(items.astype(np.int64), known.sum(axis=1)), pair_items]
+                )
+                << self._key_bits
+            )
+            + np.concatenate([neighbours[known], pair_neighbours])
+        )
+        rows, columns = candidates >> self._key_bits, candidates & self._key_mask
+        counts = self.sketch.estimate(
+            (np.minimum(rows, columns) << self._key_bits) + np.maximum(rows, columns)
+        )
+        # Pairs whose events were all removed by online updates drop out
+        kept = counts > 0
+        rows, columns, counts = rows[kept], columns[kept], counts[kept]
+        # Rank of every candidate within its item, by decreasing estimate
+        order = np.lexsort((-counts, rows))
+        rows, columns, counts = rows[order], columns[order], counts[order]
+        ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        kept = ranks < n_neighbours
+        self.neighbours[items] = -1
+        self.counts[items] = 0
+        self.neighbours[rows[kept], ranks[kept]] = columns[kept]
+        self.counts[rows[kept], ranks[kept]] = counts[kept]
+
+    @property
+    def nnz(self) -> int:
+        return int(np.count_nonzero(self.neighbours >= 0))
+
+    @property
+    def error_bound(self) -> float:
+        return self.sketch.error_bound
+
+    def get_row(self, item_index: int) -> (np.ndarray, np.ndarray):
+        """Heavy hitters of an item and their estimated co-occurrence counts, highest first"""
+        neighbours = self.neighbours[item_index]
+        known = neighbours >= 0
+        return neighbours[known], self.counts[item_index][known]
@@ -1,15 +1,19 @@
+import functools
+import os
 import pickle
 import random
 import time
 from abc import ABC, abstractmethod
-from typing import Any
+from typing import Any, Iterable
 
 import numpy as np
 import pandas as pd
 from prettytable import PrettyTable
 from tqdm import tqdm
 
+from base.cache import RecommendationCache
 from base.dataset import DataSet
+from base.neighbours import NeighbourTable
 from base.results import Results
 
 
@@ -20,6 +24,28 @@ class RecommenderModel(ABC):
 
     dataset: DataSet = None
     setup_time: float = None
+    neighbour_table: NeighbourTable | None = None
+    # Directory the neighbour table was saved to or loaded from
+    neighbour_directory: str | None = None
+    # Column of the recommendations frame with the scores stored in the neighbour table
+    neighbour_score_name: str = 'score'
+    # Recommendations of item-anchored models, see enable_cache. Any object with the get, put and clear
+    # methods of RecommendationCache can be plugged in
+    cache: RecommendationCache | None = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Cached and precomputed recommendations are stale as soon as the model is set up again
+        if 'setup_model' in cls.__dict__:
+            setup_model = cls.__dict__['setup_model']
+
+            @functools.wraps(setup_model)
+            def setup_and_clear_cache(self, *args, **kwargs):
+                self.neighbour_table = self.neighbour_directory = None
+                setup_model(self, *args, **kwargs)
+                self.clear_cache()
+
+            cls.setup_model = setup_and_clear_cache
 
     def __init__(self, dataset: DataSet, **kwargs):
         self.dataset = dataset
@@ -30,9 +56,11 @@ class RecommenderModel(ABC):
 
     def to_pickle(self, file_path='data/models/<model_name>.pickle'):
         file_path = file_path.replace('<model_name>', self.__class__.__name__)
-        with open(file_path, 'wb') as file:
+        # Written next to the target and renamed, so readers only ever see a complete pickle
+        with open(f'{file_path}.tmp', 'wb') as file:
             print('Saving model...')
             pickle.dump(self, file)
+        os.replace(f'{file_path}.tmp', file_path)
         print('Done!')
 
     @property
@@ -64,7 +92,7 @@ class RecommenderModel(ABC):
                 print(f'Chose item {item} as recommender prompt')
 
         try:
-            recommendations, model_info = self._get_recommendations(
+            recommendations, model_info = self._get_item_recommendations(
                 user, item, n_recommendations, **kwargs
             )
         except Exception as e:
@@ -83,17 +111,160 @@ class RecommenderModel(ABC):
             ]
         return results, model_info
 
+    def _get_item_recommendations(
+        self, user: str, item: str, n_recommendations: int, **kwargs
+    ) -> (pd.Series, Any):
+        # Cache first, then neighbour table, then the model itself
+        key = self._get_cache_key(item, kwargs)
+        if key is not None:
+            cached = self.cache.get(key, n_recommendations)
+            if cached is not None:
+                recommendations, model_info = cached
+                # Callers get their own copies, so columns they add never reach the cache
+                return (
+                    recommendations[:n_recommendations].copy(),
+                    model_info.iloc[:n_recommendations].copy(),
+                )
+        result = self._get_precomputed_recommendations(
+            item, n_recommendations
+        ) or self._get_recommendations(user, item, n_recommendations, **kwargs)
+        if key is not None:
+            recommendations, model_info = result
+            self.cache.put(
+                key, n_recommendations, (recommendations.copy(), model_info.copy())
+            )
+        return result
+
+    def _get_cache_key(self, item: str, kwargs: dict) -> tuple | None:
+        if self.cache is None or not self.item_anchored:
+            return None
+        key = (item, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            # Unhashable recommendation parameters are never cached
+            return None
+        return key
+
+    @property
+    def item_anchored(self) -> bool:
+        """Whether recommendations depend on the item alone (the model implements _get_item_neighbours)"""
+        return (
+            type(self)._get_item_neighbours is not RecommenderModel._get_item_neighbours
+        )
+
+    def enable_cache(
+        self, max_size: int = 1024, ttl: float | None = None
+    ) -> RecommendationCache:
+        """
+        Caches the recommendations of the max_size most recently used prompts, for ttl seconds if given.
+        Requests for fewer recommendations than a cached prompt are served from it. The cache is cleared
+        whenever setup_model runs again or the model is updated.
+        """
+        if not self.item_anchored:
+            raise NotImplementedError(
+                f'{self.model_name} recommendations do not depend on the item alone, they cannot be cached'
+            )
+        self.cache = RecommendationCache(max_size, ttl)
+        return self.cache
+
+    def clear_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+
     @abstractmethod
     def _get_recommendations(
         self, user: str, item: str, n_recommendations: int, **kwargs
     ) -> (pd.Series, Any):
         pass
 
-    def evaluate_performance(self, n_runs: int = 100):
+    def _get_item_neighbours(
+        self, item_index: int, n_neighbours: int
+    ) -> (np.ndarray, np.ndarray):
+        """
+        Product indices and scores of the best n_neighbours recommendations for a product, best first. Only
+        models whose recommendations depend on the item alone implement it.
+        """
+        raise NotImplementedError(
+            f'{self.model_name} recommendations do not depend on the item alone'
+        )
+
+    def build_neighbour_table(
+        self, n_neighbours: int = 100, directory_path: str | None = None
+    ) -> NeighbourTable:
+        """
+        Offline step: precomputes the top n_neighbours recommendations of every product, so recommend answers
+        with a table lookup for up to n_neighbours recommendations. Saved to directory_path if given.
+        """
+        print('Precomputing product neighbours...')
+        n_products = self.dataset.n_products
+        self.neighbour_table = NeighbourTable(
+            np.full((n_products, n_neighbours), -1, dtype=np.int32),
+            np.full((n_products, n_neighbours), np.nan, dtype=np.float32),
+        )
+        self.refresh_neighbour_table(tqdm(range(n_products)))
+        if directory_path is not None:
+            self.neighbour_table.save(directory_path)
+        self.neighbour_directory = directory_path and os.path.abspath(directory_path)
+        print('Done!')
+        return self.neighbour_table
+
+    def refresh_neighbour_table(self, item_indices: Iterable[int]):
+        """Computes again the neighbour table rows of some products, after the model was updated"""
+        if self.neighbour_table is None:
+            return
+        item_indices = list(item_indices)
+        self.neighbour_table.set_rows(
+            item_indices,
+            [self._get_table_row(item_index) for item_index in item_indices],
+            self.dataset.n_products,
+        )
+
+    def _get_table_row(self, item_index: int) -> tuple[np.ndarray, np.ndarray] | None:
+        try:
+            return self._get_item_neighbours(
+                item_index, self.neighbour_table.n_neighbours
+            )
+        except KeyError:
+            # Products the model knows nothing about are left empty and computed on the fly
+            return None
+
+    def load_neighbour_table(self, directory_path: str):
+        self.neighbour_table = NeighbourTable.load(directory_path)
+        self.neighbour_directory = os.path.abspath(directory_path)
+
+    def _get_precomputed_recommendations(
+        self, item: str, n_recommendations: int
+    ) -> tuple[pd.Series, pd.DataFrame] | None:
+        if self.neighbour_table is None:
+            return None
+        item_index = self.dataset.product_to_index.get(item, -1)
+        neighbours = self.neighbour_table.get(item_index, n_recommendations)
+        if neighbours is None:
+            return None
+        items, scores = neighbours
+        return self._format_recommendations(item_index, items, scores)
+
+    def _format_recommendations(
+        self, item_index: int, item_indices: np.ndarray, scores: np.ndarray
+    ) -> (pd.Index, pd.DataFrame):
+        """
+        Recommendations frame for the neighbours of a product. Recommendations computed on the fly and read
+        from the neighbour table are both built here, so they have the same columns.
+        """
+        recommendations = self.dataset.products.iloc[item_indices].assign(
+            **{self.neighbour_score_name: np.asarray(scores, dtype=np.float64)}
+        )
+        return recommendations.index, recommendations
+
+    def evaluate_performance(self, n_runs: int = 100, seed: int | None = None):
+        # Draw every prompt up front, so sampling stays out of the measured loop
+        sampler = self.dataset.get_sampler(seed)
+        user_indices = sampler.sample_users(n_runs)
+        users = self.dataset.decode_users(user_indices)
+        items = self.dataset.decode_products(sampler.sample_items(user_indices))
         times = []
-        for i in tqdm(range(n_runs)):
-            user = str(self.dataset.get_random_user().name)
-            item = self.dataset.get_random_product_from_user(user)
+        for user, item in tqdm(zip(users, items), total=n_runs):
             t0 = time.perf_counter()
             _ = self.recommend(user, item, silent=True)
             t1 = time.perf_counter()
@@ -107,7 +278,7 @@ class RecommenderModel(ABC):
         print(f'Worst time: {max(times):.3f}s')
         print(f'Best time: {min(times):.3f}s')
 
-    def evaluate_accuracy(self, k: int, n_runs: int = 100):
+    def evaluate_accuracy(self, k: int, n_runs: int = 100, seed: int | None = None):
         stats = {
             'Average': lambda x: x.mean(),
             'Median': lambda x: x.median(),
@@ -152,10 +323,13 @@ class RecommenderModel(ABC):
                 'calc': lambda x, r: x.reciprocal_rank_at_k(r),
             },
         }
-        for i in tqdm(range(n_runs)):
-            user = str(self.dataset.get_random_user(for_validation=True).name)
+        sampler = self.dataset.get_sampler(seed)
+        user_indices = sampler.sample_users(n_runs, for_validation=True)
+        users = self.dataset.decode_users(user_indices)
+        items = self.dataset.decode_products(sampler.sample_items(user_indices))
+        for user, item in tqdm(zip(users, items), total=n_runs):
             results, _ = self.recommend(
-                user, n_recommendations=k, silent=True, validation_run=True
+                user, item, n_recommendations=k, silent=True, validation_run=True
             )
             for name, metric in metrics.items():
                 f = metric['calc']
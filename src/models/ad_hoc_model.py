@@ -1,5 +1,7 @@
+import numpy as np
 import pandas as pd
 
+from base.category_index import CategoryIndex
 from base.dataset import DataSet
 from models.abstract_model import RecommenderModel
 
@@ -51,50 +53,79 @@ class AdHocRecommender(RecommenderModel):
     def model_name(self) -> str:
         return "Ad-Hoc Recommender model"
 
+    @property
+    def category_index(self) -> CategoryIndex:
+        """Products by category bucket and brand, sorted by popularity and price. Rebuilt when they change"""
+        key = (id(self.dataset.products), id(self.dataset.metrics))
+        if self.__dict__.get('_category_index_key') != key:
+            self._category_index = CategoryIndex(self.dataset)
+            self._category_index_key = key
+        return self._category_index
+
     def _get_recommendations(
         self, user: str, item: str, n_recommendations: int, **kwargs
     ) -> (pd.Series, pd.DataFrame):
-        suggestions = self.dataset.products.copy()
-        query_product = suggestions.loc[item]
-        # Get category proximity
-        suggestions['category_score'] = self._get_category_score(
-            suggestions, query_product
-        )
-        suggestions = suggestions[
-            suggestions['category_score'] >= self.category_score_cutoff
-        ]
-        # Get brand proximity
-        suggestions['brand_score'] = suggestions['brand'] == query_product['brand']
-        # Get product popularity
-        suggestions['popularity_score'] = self._get_popularity_score(suggestions)
-        # Compute ad-hoc score
-        suggestions['score'] = suggestions['category_score'] * (
-            self.brand_score_weight * suggestions['brand_score']
-            + self.popularity_score_weight * suggestions['popularity_score']
-        )
-        suggestions = suggestions.sort_values(
-            by=['score', 'price'], ascending=[False, True]
+        item_index = self.dataset.product_to_index[item]
+        top_k = self._get_top_k(item_index, n_recommendations)
+        return self._format_recommendations(
+            item_index, top_k['indices'], top_k['score']
         )
-        candidates = suggestions.head(n_recommendations).drop(
-            columns=['category_id', 'category_code']
+
+    def _format_recommendations(
+        self, item_index: int, item_indices: np.ndarray, scores: np.ndarray
+    ) -> (pd.Index, pd.DataFrame):
+        # Neighbour tables only store the final score: its components are computed again for the k products
+        candidates = (
+            self.dataset.products.iloc[item_indices]
+            .drop(columns=['category_id', 'category_code'])
+            .assign(
+                **self.category_index.get_scores(
+                    item_index,
+                    item_indices,
+                    self.category_score_cutoff,
+                    self.brand_score_weight,
+                    self.popularity_score_weight,
+                )
+            )
         )
         return candidates.index, candidates
 
-    def _get_category_score(
-        self, suggestions: pd.DataFrame, anchor_product: pd.Series
-    ) -> pd.Series:
-        anchor_categories = anchor_product[self.dataset.category_fields]
-        product_categories = suggestions[self.dataset.category_fields]
-        category_match = product_categories.eq(anchor_categories, axis=1)
-        category_match_percentage = (
-            category_match.sum(axis=1) / anchor_categories.count()
+    def recommend_batch(
+        self,
+        items: list[str] | np.ndarray,
+        n_recommendations: int = 10,
+        chunk_size: int | None = None,
+    ) -> np.ndarray:
+        """
+        Recommendations for many prompt products at once, e.g. the whole catalogue for an email campaign:
+        an (n_items, n_recommendations) array of product indices (see DataSet.decode_products), padded with -1.
+        Same ranking as recommend, computed for chunks of chunk_size products over the whole catalogue.
+        """
+        item_indices = self.dataset.encode_products(items)
+        if (item_indices < 0).any():
+            raise KeyError(np.asarray(items)[item_indices < 0].tolist())
+        indices, _ = self.category_index.get_top_k_batch(
+            item_indices,
+            n_recommendations,
+            self.category_score_cutoff,
+            self.brand_score_weight,
+            self.popularity_score_weight,
+            chunk_size,
         )
-        return category_match_percentage
+        return indices
+
+    def _get_item_neighbours(
+        self, item_index: int, n_neighbours: int
+    ) -> (np.ndarray, np.ndarray):
+        top_k = self._get_top_k(item_index, n_neighbours)
+        return top_k['indices'], top_k['score']
 
-    def _get_popularity_score(self, suggestions: pd.DataFrame) -> pd.Series:
-        metrics = suggestions.merge(
-            self.dataset.metrics, left_index=True, right_index=True, how='left'
+    def _get_top_k(self, item_index: int, k: int) -> dict[str, np.ndarray]:
+        # Only the category buckets that pass the cutoff are read, not the whole catalogue
+        return self.category_index.get_top_k(
+            item_index,
+            k,
+            self.category_score_cutoff,
+            self.brand_score_weight,
+            self.popularity_score_weight,
         )
-        metrics['sales_count'] = metrics['sales_count'].fillna(0)
-        popularity = metrics['sales_count'] / metrics['sales_count'].sum()
-        return popularity
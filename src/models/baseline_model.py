@@ -1,9 +1,15 @@
-import itertools
-
+import numpy as np
 import pandas as pd
 from scipy import sparse
-from tqdm import tqdm
 
+from base.co_occurrence import (
+    get_co_occurrence_delta,
+    get_co_occurrence_matrix,
+    get_symmetric_matrix,
+    get_top_k_neighbours,
+)
+from base.external_co_occurrence import ExternalCoOccurrence
+from base.sketches import CoOccurrenceSketch
 from models.abstract_model import RecommenderModel
 
 
@@ -16,53 +22,131 @@ class BaselineRecommender(RecommenderModel):
     Gives recommendations for a given item prompt by returning the k most popular items bought together with the prompt.
     """
 
-    co_occurrence_matrix: sparse.dok_matrix
+    co_occurrence_matrix: sparse.csr_matrix | ExternalCoOccurrence | CoOccurrenceSketch
+    neighbour_score_name = 'co-popularity'
+    co_occurrence_modes = ['exact', 'external', 'sketch']
+    co_occurrence_mode: str = 'exact'
 
-    def setup_model(self, **kwargs):
+    def setup_model(
+        self,
+        block_size: int | None = None,
+        co_occurrence_mode: str = 'exact',
+        co_occurrence_directory: str | None = None,
+        max_pairs: int = 10_000_000,
+        sketch_neighbours: int = 100,
+        sketch_epsilon: float = 1e-5,
+        sketch_delta: float = 1e-3,
+        **kwargs,
+    ):
+        if co_occurrence_mode not in self.co_occurrence_modes:
+            raise ValueError(
+                f'Unknown co-occurrence mode {co_occurrence_mode}, use one of {self.co_occurrence_modes}'
+            )
+        if co_occurrence_mode == 'external' and co_occurrence_directory is None:
+            # Shards are read from the directory for the lifetime of the model, so it cannot be shared
+            raise ValueError(
+                'The external co-occurrence mode needs a co_occurrence_directory'
+            )
+        self.co_occurrence_mode = co_occurrence_mode
         print('Building co-occurrence matrix...')
-        self.co_occurrence_matrix = self._get_co_occurrence_matrix()
+        if co_occurrence_mode == 'external':
+            # Out of core: pairs are spilled to disk and merged into memory-mapped CSR shards
+            self.co_occurrence_matrix = ExternalCoOccurrence.build(
+                self.dataset.interaction_matrix('train'),
+                co_occurrence_directory,
+                max_pairs,
+            )
+        elif co_occurrence_mode == 'sketch':
+            # Approximate: Count-Min counts and the top sketch_neighbours of every item, in fixed memory
+            self.co_occurrence_matrix = CoOccurrenceSketch.build(
+                self.dataset.interaction_matrix('train'),
+                n_neighbours=sketch_neighbours,
+                epsilon=sketch_epsilon,
+                delta=sketch_delta,
+                block_size=block_size or 10_000,
+            )
+            print(
+                f'Co-occurrence estimates exceed true counts by at most {self.co_occurrence_matrix.error_bound:.0f}'
+            )
+        else:
+            self.co_occurrence_matrix = self._get_co_occurrence_matrix(block_size)
         print('Done')
 
-    def _get_co_occurrence_matrix(self) -> sparse.dok_matrix:
-        n_items = self.dataset.n_products
-        matrix = sparse.dok_array((n_items, n_items))
-        for user in tqdm(self.dataset.users.index):
-            items = self.dataset.users.loc[user, 'train_relevant_items']
-            for item1, item2 in itertools.combinations(items, 2):
-                index1 = self.dataset.product_to_index[item1]
-                index2 = self.dataset.product_to_index[item2]
-                if index2 < index1:
-                    index1, index2 = index2, index1
-                matrix[index1, index2] += 1
-        return matrix
+    def _get_co_occurrence_matrix(
+        self, block_size: int | None = None
+    ) -> sparse.csr_matrix:
+        # Xᵀ·X of the train interactions, optionally over blocks of users to bound memory. It is kept symmetric
+        # so all the pairs of an item are a single CSR row
+        interactions = self.dataset.interaction_matrix('train')
+        return get_symmetric_matrix(get_co_occurrence_matrix(interactions, block_size))
+
+    def update(self, events: pd.DataFrame):
+        """
+        Online update with new events (raw user_id, product_id and event_type, see DataSet.record_events).
+        Only the users in the events change their co-occurrences: the matrix gets X_newᵀ·X_new - X_oldᵀ·X_old
+        over their train items, and the neighbour table rows of the items whose counts changed are refreshed.
+        Dataset metrics are updated along the way, and cached recommendations are dropped.
+        """
+        if isinstance(self.co_occurrence_matrix, ExternalCoOccurrence):
+            raise NotImplementedError(
+                'External co-occurrence shards are read-only, build them again instead'
+            )
+        n_users, n_products = self.dataset.n_users, self.dataset.n_products
+        old_interactions = self.dataset.interaction_matrix('train')
+        user_indices = self.dataset.record_events(events)
+        interactions = self.dataset.interaction_matrix('train')
+        # Users new to the dataset had no train items
+        old_rows = old_interactions[user_indices[user_indices < n_users]]
+        old_rows.resize(len(user_indices), old_rows.shape[1])
+        delta = get_co_occurrence_delta(
+            old_rows, interactions[user_indices], self.dataset.n_products
+        )
+        if isinstance(self.co_occurrence_matrix, CoOccurrenceSketch):
+            self.co_occurrence_matrix.resize(self.dataset.n_products)
+            self.co_occurrence_matrix.add(delta)
+        else:
+            co_occurrence = self.co_occurrence_matrix
+            co_occurrence.resize(self.dataset.n_products, self.dataset.n_products)
+            co_occurrence = (co_occurrence + delta).tocsr()
+            co_occurrence.eliminate_zeros()
+            co_occurrence.sort_indices()
+            self.co_occurrence_matrix = co_occurrence
+        self.refresh_neighbour_table(
+            np.union1d(delta.row, np.arange(n_products, self.dataset.n_products))
+        )
+        self.clear_cache()
 
     @property
     def model_name(self) -> str:
-        return "Baseline Recommender model"
+        return f"Baseline Recommender model ({self.co_occurrence_mode})"
 
     def _get_recommendations(
         self, user: str, item: str, n_recommendations: int, **kwargs
     ) -> (pd.Series, pd.DataFrame):
         anchor_item_index = self.dataset.product_to_index[item]
-        recs = {}
-        for item_index in range(self.dataset.n_products):
-            i, j = min(item_index, anchor_item_index), max(
-                item_index, anchor_item_index
-            )
-            co_occurrence = self.co_occurrence_matrix[i, j]
-            co_item = self.dataset.index_to_product[item_index]
-            recs[co_item] = co_occurrence
-        recs = pd.Series(recs, name='co-popularity')
-        recs = pd.merge(
-            self.dataset.products, recs, left_index=True, right_index=True, how='right'
+        # Only the anchor's row is read, and only the k winners are joined with product metadata
+        item_indices, counts = get_top_k_neighbours(
+            self.co_occurrence_matrix, anchor_item_index, n_recommendations
         )
-        recs = recs.sort_values('co-popularity', ascending=False).head(
-            n_recommendations
+        return self._format_recommendations(anchor_item_index, item_indices, counts)
+
+    def _format_recommendations(
+        self, item_index: int, item_indices: np.ndarray, scores: np.ndarray
+    ) -> (pd.Index, pd.DataFrame):
+        # Counts are stored as float32 in the neighbour table, which is exact for any realistic count
+        recs = self.dataset.products.iloc[item_indices].assign(
+            **{self.neighbour_score_name: np.asarray(scores).astype(np.int64)}
         )
         return recs.index, recs
 
+    def _get_item_neighbours(
+        self, item_index: int, n_neighbours: int
+    ) -> (np.ndarray, np.ndarray):
+        return get_top_k_neighbours(self.co_occurrence_matrix, item_index, n_neighbours)
+
     @property
     def matrix_density(self) -> float:
-        nnz = self.co_occurrence_matrix.getnnz()
+        # Every pair is stored twice in the symmetric matrix: count it once, as the triangular matrix did
+        nnz = self.co_occurrence_matrix.nnz // 2
         n_rows, n_cols = self.co_occurrence_matrix.shape
         return nnz / (n_rows * n_cols)
@@ -52,19 +52,18 @@ class MatrixFactorizationRecommender(RecommenderModel):
         print('Done!')
 
     def _extract_user_item_confidence(self) -> pd.DataFrame:
-        confidence = self.dataset.views.groupby(['user_id', 'product_id']).agg(
-            confidence=('category_id', 'count')
-        )
+        confidence = self.dataset.views.groupby(
+            ['user_id', 'product_id'], observed=True
+        ).agg(confidence=('category_id', 'count'))
         confidence = confidence.reset_index()
         return confidence
 
     def _train_ALS_model(self, cross_validate_model: bool) -> ALSModel:
         print('Parsing data...')
         confidence = self.user_item_confidence
-        confidence['user'] = confidence['user_id'].str.split('-').str[1].astype(int)
-        confidence['product'] = (
-            confidence['product_id'].str.split('-').str[1].astype(int)
-        )
+        # Categorical codes are the positions in dataset.users and dataset.products
+        confidence['user'] = confidence['user_id'].cat.codes.astype('int32')
+        confidence['product'] = confidence['product_id'].cat.codes.astype('int32')
         confidence_DF = self.spark.createDataFrame(
             confidence[['user', 'product', 'confidence']]
         )
@@ -101,7 +100,7 @@ class MatrixFactorizationRecommender(RecommenderModel):
     def _get_recommendations(
         self, user: str, item: str, n_recommendations: int, **kwargs
     ) -> (pd.Series, Any):
-        user_index = int(user.split('-')[1])
+        user_index = int(self.dataset.encode_users([user])[0])
         user_DF = self.spark.createDataFrame(
             pd.DataFrame([[user_index]], columns=['user'])
         )
@@ -110,10 +109,13 @@ class MatrixFactorizationRecommender(RecommenderModel):
             user_DF, n_recommendations
         ).toPandas()
         recommendations: list = recommendations_DF.loc[0, 'recommendations']
-        recommendations: dict = {
-            'P-' + str(row.product): row.rating for row in recommendations
-        }
-        recommendations: pd.Series = pd.Series(recommendations, name='score')
+        recommendations: pd.Series = pd.Series(
+            [row.rating for row in recommendations],
+            index=self.dataset.decode_products(
+                [row.product for row in recommendations]
+            ),
+            name='score',
+        )
         recommendations.index.name = 'product_id'
 
         recommendations: pd.DataFrame = self.dataset.products.merge(
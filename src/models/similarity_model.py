@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from base.co_occurrence import get_similarity_matrix, get_top_k_neighbours
+from base.dataset import DataSet
+from models.abstract_model import RecommenderModel
+
+
+class SimilarityRecommender(RecommenderModel):
+    """
+    Variant of the baseline recommender that ranks items bought "together" with the prompt by a normalized
+    similarity instead of raw co-occurrence counts, which favour blockbuster items:
+    - jaccard: users with both items over users with either of them
+    - cosine: users with both items over the geometric mean of the users of each item
+    - lift: how many times more often the items are bought together than if they were independent
+
+    Similarities are computed from the train interactions in blocks of items, keeping only those above
+    similarity_threshold and the top_n of every item, so the matrix stays as sparse as the recommendations need.
+    """
+
+    similarity_matrix: sparse.csr_matrix
+    measure: str
+
+    def __init__(
+        self,
+        dataset: DataSet,
+        measure: str = 'cosine',
+        similarity_threshold: float = 0.0,
+        top_n: int | None = 100,
+        block_size: int = 1024,
+        **kwargs,
+    ):
+        super().__init__(
+            dataset,
+            measure=measure,
+            similarity_threshold=similarity_threshold,
+            top_n=top_n,
+            block_size=block_size,
+            **kwargs,
+        )
+
+    def setup_model(
+        self,
+        measure: str,
+        similarity_threshold: float,
+        top_n: int | None,
+        block_size: int,
+        **kwargs,
+    ):
+        self.measure = measure
+        self.neighbour_score_name = measure
+        print('Building similarity matrix...')
+        self.similarity_matrix = get_similarity_matrix(
+            self.dataset.interaction_matrix('train'),
+            measure=measure,
+            block_size=block_size,
+            threshold=similarity_threshold,
+            top_n=top_n,
+        )
+        print('Done')
+
+    @property
+    def model_name(self) -> str:
+        return f"Similarity Recommender model ({self.measure})"
+
+    def _get_recommendations(
+        self, user: str, item: str, n_recommendations: int, **kwargs
+    ) -> (pd.Series, pd.DataFrame):
+        anchor_item_index = self.dataset.product_to_index[item]
+        item_indices, similarities = self._get_item_neighbours(
+            anchor_item_index, n_recommendations
+        )
+        return self._format_recommendations(
+            anchor_item_index, item_indices, similarities
+        )
+
+    def _get_item_neighbours(
+        self, item_index: int, n_neighbours: int
+    ) -> (np.ndarray, np.ndarray):
+        # Only items with a similarity are recommended: padding with unrelated items (or the prompt itself)
+        # would rank them as if they were similar
+        return get_top_k_neighbours(
+            self.similarity_matrix, item_index, n_neighbours, pad=False
+        )
+
+    @property
+    def matrix_density(self) -> float:
+        nnz = self.similarity_matrix.getnnz()
+        n_rows, n_cols = self.similarity_matrix.shape
+        return nnz / (n_rows * n_cols)
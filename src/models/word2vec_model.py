@@ -1,9 +1,15 @@
-from typing import Any
+import copy
+import random
+import time
+from typing import Any, Iterable
 
 import gensim.models
+import numpy as np
 import pandas as pd
-import tqdm
+from prettytable import PrettyTable
 
+from base.ann import IVFIndex
+from base.sessions import Sessions
 from models.abstract_model import RecommenderModel
 
 
@@ -14,40 +20,47 @@ class Word2VecRecommender(RecommenderModel):
     Hopes to maximize the click-rate of related products, with the assumption that it also increases the purchase rate of those products.
     """
 
-    sessions: list[list[str]]
+    # Training corpus, None in pickled models trained on in-memory sessions
+    sessions: Sessions | None
     model: gensim.models.Word2Vec
+    neighbour_score_name = 'similarity'
+    # Approximate nearest neighbours of the product vectors, see build_ann_index
+    ann_index: IVFIndex | None = None
+    # Directory the ANN index of the current version was saved to or loaded from. Updates save new versions
+    # of the index and the neighbour table next to the current ones, see _get_version_directory
+    ann_directory: str | None = None
+    # Trainings so far, full or incremental
+    version: int = 0
 
     @property
     def model_name(self) -> str:
         return "Word2Vec SG session-based Recommender"
 
-    def setup_model(self, **kwargs):
+    def __getstate__(self) -> dict:
+        # Sessions are only read while training, so in-memory ones are left out and the saved model does not
+        # embed the corpus. Saved ones are pickled as their path
+        state = self.__dict__.copy()
+        sessions = state.get('sessions')
+        if sessions is not None and sessions.directory_path is None:
+            state['sessions'] = None
+        return state
+
+    def setup_model(self, sessions_directory: str | None = None, **kwargs):
+        self.ann_index = self.ann_directory = None
         print('Extracting user sessions...')
         self.sessions = self._extract_user_sessions()
+        if sessions_directory is not None:
+            # Training streams the sessions from disk, and the saved model only keeps their path: every model
+            # needs a directory of its own
+            self.sessions = self.sessions.save(sessions_directory)
         print('Training model...')
         self.model = self._train_word2vec_model(**kwargs)
+        self.version += 1
         print('Done!')
 
-    def _extract_user_sessions(self) -> list[list[str]]:
-        group_count = self.dataset.all_transactions.groupby('user_session').agg(
-            item_count=('product_id', 'count')
-        )['item_count']
-
-        events = self.dataset.all_transactions
-        events = events.sort_values(['user_session', 'event_time'])
-        # Build sessions by grouping by "user_session". Avoid groupby if possible
-        sessions = []
-        i = 0
-        with tqdm.tqdm(total=events.shape[0]) as progress_bar:
-            while i < events.shape[0]:
-                session_id = events.iloc[i]['user_session']
-                session_length = group_count[session_id]
-                session_items = list(events.iloc[i : i + session_length]['product_id'])
-                sessions.append(list(dict.fromkeys(session_items)))
-                i += session_length
-                progress_bar.update(session_length)
-        sessions = [session for session in sessions if len(session) > 1]
-        return sessions
+    def _extract_user_sessions(self) -> Sessions:
+        # Sorted once by session and time, with session boundaries and repeated products found on arrays
+        return Sessions.extract(self.dataset)
 
     def _train_word2vec_model(self, **kwargs) -> gensim.models.Word2Vec:
         kwargs['workers'] = 4
@@ -63,13 +76,258 @@ class Word2VecRecommender(RecommenderModel):
         )
         return model
 
+    def build_ann_index(
+        self,
+        n_lists: int | None = None,
+        n_probe: int = 8,
+        directory_path: str | None = None,
+    ) -> IVFIndex:
+        """
+        Offline step: IVF index of the product vectors (see IVFIndex), so recommendations compare the prompt
+        with the vectors of n_probe lists instead of the whole vocabulary. Saved to directory_path if given,
+        a directory of this model's own, and the pickled model then only keeps its path.
+        """
+        print('Building ANN index...')
+        self.ann_index = IVFIndex.build(self.model.wv.vectors, n_lists, n_probe)
+        if directory_path is not None:
+            self.ann_index.save(directory_path)
+        self.ann_directory = self.ann_index.directory_path
+        print('Done!')
+        return self.ann_index
+
+    def load_ann_index(self, directory_path: str):
+        self.ann_index = IVFIndex.load(directory_path)
+        self.ann_directory = self.ann_index.directory_path
+
+    def update(self, events: pd.DataFrame, epochs: int = 5) -> int:
+        """
+        Incremental training with new events (raw user_id, product_id, event_type and user_session, see
+        DataSet.record_events): only the sessions in the events are extracted, their new products are added
+        to the vocabulary and training continues for epochs passes over those sessions. The ANN index keeps
+        its centroids and gets the new vectors, and the neighbour table is built again. The sessions
+        attribute keeps the corpus of the last full training.
+
+        The new version (model, ANN index and neighbour table) is built on the side and swapped in at the end
+        in a single assignment, so recommendations come from the previous version meanwhile. Saved ANN
+        indexes and neighbour tables of new versions go to new directories, <directory>_v<version>, which
+        ann_directory and neighbour_directory name afterwards, so pickles of previous versions stay valid.
+        Returns the new version.
+        """
+        self.dataset.record_events(events)
+        session_ids = pd.Index([])
+        if 'user_session' in events:
+            session_ids = 'S-' + pd.Index(
+                events['user_session'].dropna().unique()
+            ).astype(str)
+        print('Extracting new sessions...')
+        sessions = Sessions.extract(self.dataset, session_ids=session_ids)
+        model = copy.deepcopy(self.model)
+        if len(sessions):
+            print('Updating vocabulary...')
+            model.build_vocab(sessions, update=True)
+            print('Training neural network...')
+            model.train(sessions, total_examples=model.corpus_count, epochs=epochs)
+        ann_index = self.ann_index
+        if ann_index is not None:
+            print('Updating ANN index...')
+            ann_index = ann_index.reassign(model.wv.vectors)
+            if self.ann_directory is not None:
+                ann_index.save(self._get_version_directory(self.ann_directory))
+        neighbour_table, neighbour_directory = (
+            self.neighbour_table,
+            self.neighbour_directory,
+        )
+        if neighbour_table is not None:
+            # Built by a shallow copy of this recommender holding the new version
+            updated = copy.copy(self)
+            updated.model, updated.ann_index = model, ann_index
+            neighbour_table = updated.build_neighbour_table(
+                neighbour_table.n_neighbours,
+                neighbour_directory
+                and self._get_version_directory(neighbour_directory),
+            )
+            neighbour_directory = updated.neighbour_directory
+        (
+            self.model,
+            self.ann_index,
+            self.ann_directory,
+            self.neighbour_table,
+            self.neighbour_directory,
+            self.version,
+        ) = (
+            model,
+            ann_index,
+            ann_index and ann_index.directory_path,
+            neighbour_table,
+            neighbour_directory,
+            self.version + 1,
+        )
+        self.clear_cache()
+        print('Done!')
+        return self.version
+
+    def _get_version_directory(self, directory_path: str) -> str:
+        # <directory>_v<version> for the next version, from the directory of the current one
+        base_path = directory_path.removesuffix(f'_v{self.version}')
+        return f'{base_path}_v{self.version + 1}'
+
     def _get_recommendations(
         self, user: str, item: str, n_recommendations: int, **kwargs
     ) -> (pd.Series, Any):
-        recommendations = self.model.wv.most_similar(
-            positive=item, topn=n_recommendations
+        items, similarities = self._get_similar_items(item, n_recommendations)
+        return self._format_recommendations(
+            self.dataset.product_to_index[item],
+            self.dataset.encode_products(items),
+            similarities,
+        )
+
+    def _format_recommendations(
+        self, item_index: int, item_indices: np.ndarray, scores: np.ndarray
+    ) -> (pd.Index, pd.DataFrame):
+        recommendations = self.dataset.products.iloc[item_indices].drop(
+            columns=['category_id', 'category_code']
         )
-        recommendations = self.dataset.products.loc[
-            [rec[0] for rec in recommendations]
-        ].drop(columns=['category_id', 'category_code'])
         return recommendations.index, recommendations
+
+    def _get_item_neighbours(
+        self, item_index: int, n_neighbours: int
+    ) -> (np.ndarray, np.ndarray):
+        items, similarities = self._get_similar_items(
+            self.dataset.index_to_product[item_index], n_neighbours
+        )
+        return self.dataset.encode_products(items), similarities
+
+    @property
+    def normed_vectors(self) -> np.ndarray:
+        """L2-normalized float32 product vectors, in vocabulary order. Computed again when the vectors change"""
+        vectors = self.model.wv.vectors
+        key = (id(vectors), vectors.shape)
+        if self.__dict__.get('_normed_vectors_key') != key:
+            self._normed_vectors = self.model.wv.get_normed_vectors().astype(
+                np.float32, copy=False
+            )
+            self._normed_vectors_key = key
+        return self._normed_vectors
+
+    def most_similar_batch(
+        self, items: list[str] | np.ndarray, k: int = 10, block_size: int = 256
+    ) -> (np.ndarray, np.ndarray):
+        """
+        Most similar products to many prompt products at once, as most_similar for each of them: (n_items, k)
+        arrays of product indices (see DataSet.decode_products) and cosine similarities, best first. Blocks of
+        block_size prompt vectors are multiplied with all the normalized vectors at once.
+        """
+        key_to_index = self.model.wv.key_to_index
+        # Unknown products raise a KeyError, as in most_similar
+        rows = np.array([key_to_index[item] for item in items], dtype=np.int64)
+        vectors = self.normed_vectors
+        products = self.dataset.encode_products(self.model.wv.index_to_key)
+        k = min(k, len(vectors) - 1)
+        indices = np.full((len(rows), max(k, 0)), -1, dtype=np.int32)
+        similarities = np.full((len(rows), max(k, 0)), np.nan, dtype=np.float32)
+        if k <= 0:
+            return indices, similarities
+        for start in range(0, len(rows), block_size):
+            block = rows[start : start + block_size]
+            scores = vectors[block] @ vectors.T
+            # The prompt is not its own recommendation
+            scores[np.arange(len(block)), block] = -np.inf
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            indices[start : start + len(block)] = products[top]
+            similarities[start : start + len(block)] = np.take_along_axis(
+                top_scores, order, axis=1
+            )
+        return indices, similarities
+
+    def refresh_neighbour_table(self, item_indices: Iterable[int]):
+        # Without ANN index, rows are computed with batched queries instead of one most_similar per product
+        if self.neighbour_table is None or self.ann_index is not None:
+            return super().refresh_neighbour_table(item_indices)
+        item_indices = np.fromiter(item_indices, dtype=np.int64)
+        items = self.dataset.decode_products(item_indices)
+        known = np.flatnonzero([item in self.model.wv.key_to_index for item in items])
+        indices, similarities = self.most_similar_batch(
+            items[known], self.neighbour_table.n_neighbours
+        )
+        rows = [None] * len(item_indices)
+        for position, item_neighbours, item_similarities in zip(
+            known, indices, similarities
+        ):
+            found = item_neighbours >= 0
+            rows[position] = (item_neighbours[found], item_similarities[found])
+        self.neighbour_table.set_rows(item_indices, rows, self.dataset.n_products)
+
+    def _get_similar_items(
+        self, item: str, n_items: int, exact: bool = False
+    ) -> (list[str], np.ndarray):
+        # Labels and similarities of the most similar products, from the ANN index if there is one
+        if exact or self.ann_index is None:
+            recommendations = self.model.wv.most_similar(positive=item, topn=n_items)
+            items, similarities = zip(*recommendations) if recommendations else ((), ())
+            return list(items), np.array(similarities)
+        # The prompt is its own nearest neighbour: search one more and leave it out
+        item_row = self.model.wv.key_to_index[item]
+        rows, similarities = self.ann_index.search(
+            self.model.wv.vectors[item_row], n_items + 1
+        )
+        kept = rows != item_row
+        rows, similarities = rows[kept][:n_items], similarities[kept][:n_items]
+        return [self.model.wv.index_to_key[row] for row in rows], similarities
+
+    def evaluate_ann(
+        self,
+        k: int = 10,
+        n_probes: tuple[int, ...] = (1, 2, 4, 8, 16, 32),
+        n_runs: int = 100,
+        seed: int | None = None,
+    ):
+        """Recall@k and latency of the ANN index for several n_probe values, against brute-force most_similar"""
+        if self.ann_index is None:
+            raise ValueError('There is no ANN index, build or load one first')
+        items = random.Random(seed).choices(self.model.wv.index_to_key, k=n_runs)
+        exact_items, exact_times = [], []
+        for item in items:
+            t0 = time.perf_counter()
+            similar_items, _ = self._get_similar_items(item, k, exact=True)
+            t1 = time.perf_counter()
+            exact_items.append(set(similar_items))
+            exact_times.append(t1 - t0)
+
+        table = PrettyTable(['Search', f'R@{k}', 'Average time', 'Worst time'])
+        table.add_row(
+            [
+                'Brute force',
+                f'{1:.4f}',
+                f'{np.mean(exact_times) * 1000:.3f}ms',
+                f'{np.max(exact_times) * 1000:.3f}ms',
+            ]
+        )
+        default_n_probe = self.ann_index.n_probe
+        for n_probe in n_probes:
+            self.ann_index.n_probe = min(n_probe, self.ann_index.n_lists)
+            recalls, times = [], []
+            for item, expected in zip(items, exact_items):
+                t0 = time.perf_counter()
+                similar_items, _ = self._get_similar_items(item, k)
+                t1 = time.perf_counter()
+                recalls.append(
+                    len(expected.intersection(similar_items)) / max(len(expected), 1)
+                )
+                times.append(t1 - t0)
+            table.add_row(
+                [
+                    f'IVF n_probe={self.ann_index.n_probe}/{self.ann_index.n_lists}',
+                    f'{np.mean(recalls):.4f}',
+                    f'{np.mean(times) * 1000:.3f}ms',
+                    f'{np.max(times) * 1000:.3f}ms',
+                ]
+            )
+        self.ann_index.n_probe = default_n_probe
+
+        print('------------------------------------')
+        print(f'{self.model_name} - ANN index')
+        print('------------------------------------')
+        print(table)